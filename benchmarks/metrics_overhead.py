@@ -0,0 +1,62 @@
+# Measure the cost of recording a metric, in nanoseconds per call.
+#
+#   python3 benchmarks/metrics_overhead.py [calls]
+#
+# "loop" is an empty loop of the same length, its time is subtracted from the others.
+# "histogram + clock" is what a relay loop pays: two monotonic calls and one observe.
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fusion_backend import metrics
+
+
+def _loop(count):
+    for _ in range(count):
+        pass
+
+
+def _counter(count):
+    counter = metrics.counter('benchmark_total', "benchmark")
+    for _ in range(count):
+        counter.inc()
+
+
+def _gauge(count):
+    gauge = metrics.gauge('benchmark_value', "benchmark")
+    for i in range(count):
+        gauge.set(i)
+
+
+def _histogram(count):
+    histogram = metrics.histogram('benchmark_seconds', "benchmark")
+    for _ in range(count):
+        histogram.observe(0.003)
+
+
+def _histogram_clock(count):
+    histogram = metrics.histogram('benchmark_loop_seconds', "benchmark")
+    monotonic = time.monotonic
+    for _ in range(count):
+        start = monotonic()
+        histogram.observe(monotonic() - start)
+
+
+def measure(func, count):
+    start = time.perf_counter()
+    func(count)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    call_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    empty = measure(_loop, call_count)
+    for name, func in (('counter', _counter), ('gauge', _gauge), ('histogram', _histogram),
+                       ('histogram + clock', _histogram_clock)):
+        elapsed = measure(func, call_count) - empty
+        print("%-18s %8d calls %8.1f ns/call" % (name, call_count, elapsed / call_count * 1e9))
+    start = time.perf_counter()
+    text = metrics.render()
+    print("render %d bytes in %.3f ms" % (len(text), (time.perf_counter() - start) * 1000))
@@ -0,0 +1,75 @@
+# Compare the throughput of the tcp relay forwarding modes.
+#
+#   python3 benchmarks/relay_forward_mode.py [size in MiB]
+#
+# A local sink server counts the received bytes, and a client pushes the
+# payload through the relay once for every mode.
+import sys
+import os
+import time
+import socket
+import threading
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fusion_backend.modules.relay import MultiThreadsRelay, _SPLICE_SUPPORTED
+
+
+def _sink(server: socket.socket, done: threading.Event, result: list):
+    conn, addr = server.accept()
+    total = 0
+    while True:
+        data = conn.recv(262144)
+        if not data:
+            break
+        total += len(data)
+    conn.close()
+    result.append(total)
+    done.set()
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def bench(mode, size):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    done = threading.Event()
+    result = []
+    threading.Thread(target=_sink, args=(server, done, result), daemon=True).start()
+
+    relay = MultiThreadsRelay()
+    relay_port = _free_port()
+    relay.add_relay('127.0.0.1', relay_port, {
+        'destination': '127.0.0.1:%d' % server.getsockname()[1],
+        'mode': mode
+    })
+    threading.Thread(target=relay.run, daemon=True).start()
+
+    chunk = b'\0' * 1048576
+    client = socket.create_connection(('127.0.0.1', relay_port))
+    start = time.perf_counter()
+    for _ in range(size):
+        client.sendall(chunk)
+    client.close()
+    done.wait()
+    elapsed = time.perf_counter() - start
+    server.close()
+    print("%-8s %8.1f MiB/s (%d bytes in %.2fs)" % (mode, result[0] / elapsed / 1048576, result[0], elapsed))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    total_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    bench('buffer', total_size)
+    if _SPLICE_SUPPORTED:
+        bench('splice', total_size)
+    else:
+        print("splice is not supported on this platform")
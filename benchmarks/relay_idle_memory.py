@@ -0,0 +1,63 @@
+# Measure the memory held by the tcp relay for idle connections, in bytes per connection.
+#
+#   python3 benchmarks/relay_idle_memory.py [connections]
+#
+# Every connection sends one small message through the relay and then stays open.
+# Only the python side is measured, socket buffers in the kernel are not counted.
+import sys
+import os
+import socket
+import threading
+import time
+import tracemalloc
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fusion_backend.modules.relay import MultiThreadsRelay
+
+
+def _accept(server: socket.socket, accepted: list):
+    while True:
+        try:
+            conn, addr = server.accept()
+        except OSError:
+            return
+        accepted.append(conn)
+
+
+def measure(count):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1024)
+    accepted = []
+    threading.Thread(target=_accept, args=(server, accepted), daemon=True).start()
+    relay = MultiThreadsRelay()
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    relay_port = probe.getsockname()[1]
+    probe.close()
+    relay.add_relay('127.0.0.1', relay_port, '127.0.0.1:%d' % server.getsockname()[1])
+    threading.Thread(target=relay.run, daemon=True).start()
+    time.sleep(0.2)
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    clients = []
+    for _ in range(count):
+        client = socket.create_connection(('127.0.0.1', relay_port))
+        client.sendall(b'hello')
+        clients.append(client)
+    while len(accepted) < count:
+        time.sleep(0.05)
+    for conn in accepted:
+        conn.recv(16)
+    time.sleep(0.2)
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    print("%8d connections %12d bytes %10.1f bytes/connection" % (count, used, used / count))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    measure(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,84 @@
+# Measure the cpu time used by the shadowsocks module's control thread in steady state.
+#
+#   python3 benchmarks/shadowsocks_idle_cpu.py [seconds] [commands per second]
+#
+# The manager is a stand-in process (see shadowsocks_standin.py), whose cpu time is not counted.
+# The "before" loop is a copy of the control loop the module used previously: select() with
+# the control socket in the write list, which returns at once as a udp socket is always writable.
+import sys
+import os
+import queue
+import select
+import socket
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import shadowsocks_standin
+shadowsocks_standin.install()
+
+from fusion_backend.modules import shadowsocks
+
+
+def _before(duration, rate):
+    control_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    control_socket.setblocking(False)
+    control_socket.bind(('127.0.0.1', 0))
+    send_queue = queue.Queue()
+    stopped = threading.Event()
+
+    def worker():
+        while not stopped.is_set():
+            rlist, wlist, elist = select.select([control_socket], [control_socket], [])
+            if rlist:
+                control_socket.recv(1506)
+            elif wlist:
+                try:
+                    send_queue.get_nowait()
+                except queue.Empty:
+                    continue
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    used = _run(duration, rate, lambda port: send_queue.put(port))
+    stopped.set()
+    thread.join()
+    control_socket.close()
+    return used
+
+
+def _after(duration, rate):
+    manager = shadowsocks.get_module(queue.Queue(), {'manager_address': '127.0.0.1:17851', 'method': 'aes-256-cfb',
+                                                     'server': '127.0.0.1', 'timeout': 60})
+    manager.start()
+    if not manager.wait_ready(10):
+        raise RuntimeError("stand-in manager did not start")
+    used = _run(duration, rate, lambda port: manager.update([
+        {'action': 'add', 'conf': {'server_port': port, 'password': 'benchmark'}}]))
+    manager.stop()
+    return used
+
+
+def _run(duration, rate, command):
+    # cpu time of this process while commands are issued at the given rate
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    sent = 0
+    while time.monotonic() - start < duration:
+        if rate:
+            due = int((time.monotonic() - start) * rate)
+            while sent < due:
+                command(20000 + sent % 10000)
+                sent += 1
+        time.sleep(0.01)
+    return time.process_time() - cpu_start
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    commands = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    for name, func in (('before', _before), ('after', _after)):
+        cpu = func(seconds, commands)
+        print("%-8s %6.1fs %6d commands/s %8.3fs cpu %6.1f%% of a core" %
+              (name, seconds, commands, cpu, cpu / seconds * 100))
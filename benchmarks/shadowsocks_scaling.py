@@ -0,0 +1,72 @@
+# Measure the traffic forwarded by the shadowsocks module with 1, 2, 4... manager processes.
+#
+#   python3 benchmarks/shadowsocks_scaling.py [seconds] [workers...]
+#
+# The managers are stand-ins (see shadowsocks_standin.py), which send back what they receive after
+# a cipher written in python, so a manager is bound to one core like the real server. Every port
+# gets one connection from one of the client processes, which send a block and wait for it to come
+# back. Throughput only grows with the workers up to the number of cores, the clients need some too.
+import sys
+import os
+import multiprocessing
+import queue
+import socket
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import shadowsocks_standin
+shadowsocks_standin.install()
+
+from fusion_backend.modules import shadowsocks
+
+_PORTS = 64
+_BLOCK = 16384
+
+
+def _client(ports, duration, results):
+    connections = [socket.create_connection(('127.0.0.1', port)) for port in ports]
+    block = os.urandom(_BLOCK)
+    forwarded = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for connection in connections:
+            connection.sendall(block)
+            received = 0
+            while received < _BLOCK:
+                received += len(connection.recv(_BLOCK - received))
+            forwarded += _BLOCK
+    for connection in connections:
+        connection.close()
+    results.put(forwarded)
+
+
+def measure(workers, duration, first_port):
+    manager = shadowsocks.get_module(queue.Queue(), {'manager_address': '127.0.0.1:%d' % (first_port - 100),
+                                                     'method': 'aes-256-cfb', 'server': '127.0.0.1',
+                                                     'timeout': 60, 'workers': workers})
+    manager.start()
+    if not manager.wait_ready(10):
+        raise RuntimeError("stand-in manager did not start")
+    ports = list(range(first_port, first_port + _PORTS))
+    manager.update([{'action': 'sync', 'conf': [{'server_port': port, 'password': 'benchmark'} for port in ports]}])
+    client_count = max(multiprocessing.cpu_count(), workers)
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=_client, args=(ports[index::client_count], duration, results))
+               for index in range(client_count)]
+    for client in clients:
+        client.start()
+    forwarded = sum(results.get() for _ in clients)
+    for client in clients:
+        client.join()
+    manager.stop()
+    return forwarded
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    worker_counts = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4]
+    print("%d cores, %d ports" % (multiprocessing.cpu_count(), _PORTS))
+    for run, worker_count in enumerate(worker_counts):
+        total = measure(worker_count, seconds, 30000 + run * 1000)
+        print("%2d workers %6.1fs %8.1f MB/s" % (worker_count, seconds, total / seconds / 1e6))
@@ -0,0 +1,122 @@
+# A stand-in for shadowsocks.manager, so the shadowsocks benchmarks run without shadowsocks installed.
+#
+# It speaks the manager protocol on manager_address: "ping:" is answered with "pong", "add:" and
+# "remove:" with "ok", and the ports which had traffic get a "stat: " datagram every stat_interval
+# seconds. Like the real manager, a command is not answered at all when neither it nor the
+# configuration has a server_port, so a plain "ping" is not. An added port listens on server and sends
+# back whatever it receives, after passing it through _cipher, so forwarding costs cpu time in
+# proportion to the traffic like the real server.
+# The worker processes are forked, so install() has to be called before the module starts.
+import json
+import os
+import selectors
+import socket
+import sys
+import time
+import types
+
+
+def _cipher(data):
+    # as slow as a cipher written in python, about 20 MB/s
+    return bytes(byte ^ 0x5a for byte in data)
+
+
+def run(config):
+    address = config['manager_address']
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        control = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+        control.bind((host, int(port)))
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        control = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        control.bind(address)
+    control.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(control, selectors.EVENT_READ)
+    stat_interval = float(config.get('stat_interval', 1))
+    # port -> listening socket
+    listeners = {}
+    # port -> bytes forwarded since the last statistic
+    traffic = {}
+    client = None
+    next_stat = time.monotonic() + stat_interval
+    while True:
+        for key, mask in selector.select(max(next_stat - time.monotonic(), 0)):
+            if key.fileobj is control:
+                try:
+                    data, client = control.recvfrom(65536)
+                except BlockingIOError:
+                    continue
+                command, _, payload = data.partition(b':')
+                command_config = dict(config)
+                if payload:
+                    try:
+                        command_config.update(json.loads(payload.decode()))
+                    except ValueError:
+                        continue
+                if 'server_port' not in command_config:
+                    continue
+                if command == b'ping':
+                    control.sendto(b'pong', client)
+                    continue
+                port = command_config['server_port']
+                if command == b'add' and port not in listeners:
+                    listener = None
+                    try:
+                        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                        listener.bind((config['server'], port))
+                    except OSError:
+                        # like the real manager, a port which can not be bound, or no socket left
+                        # for it, is acknowledged anyway
+                        if listener is not None:
+                            listener.close()
+                    else:
+                        listener.listen(128)
+                        listener.setblocking(False)
+                        selector.register(listener, selectors.EVENT_READ, ('listener', port))
+                        listeners[port] = listener
+                elif command == b'remove' and port in listeners:
+                    listener = listeners.pop(port)
+                    selector.unregister(listener)
+                    listener.close()
+                elif command not in (b'add', b'remove'):
+                    continue
+                control.sendto(b'ok', client)
+            elif key.data[0] == 'listener':
+                try:
+                    connection, _ = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                selector.register(connection, selectors.EVENT_READ, ('connection', key.data[1]))
+            else:
+                try:
+                    data = key.fileobj.recv(65536)
+                except OSError:
+                    data = b''
+                if not data:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                key.fileobj.sendall(_cipher(data))
+                traffic[key.data[1]] = traffic.get(key.data[1], 0) + len(data)
+        if time.monotonic() >= next_stat:
+            next_stat = time.monotonic() + stat_interval
+            # the real manager sends at most 50 ports in one datagram, and only the ports which had traffic
+            items = list(traffic.items())
+            traffic.clear()
+            if client is None:
+                continue
+            for index in range(0, len(items), 50):
+                control.sendto(b'stat: ' + json.dumps(dict(items[index:index + 50])).encode(), client)
+
+
+def install():
+    manager = types.ModuleType('shadowsocks.manager')
+    manager.run = run
+    package = types.ModuleType('shadowsocks')
+    package.manager = manager
+    sys.modules['shadowsocks'] = package
+    sys.modules['shadowsocks.manager'] = manager
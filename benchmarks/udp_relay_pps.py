@@ -0,0 +1,84 @@
+# Measure how many small datagrams per second the udp relay forwards on one core.
+#
+#   python3 benchmarks/udp_relay_pps.py [seconds] [clients]
+#
+# The relay runs in its own process. Client processes flood it with 64 byte
+# datagrams and a sink process counts what arrives at the destination.
+import sys
+import os
+import time
+import socket
+import logging
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fusion_backend.modules.relay import MultiThreadUDPRelay
+
+
+def _sink(port, duration, result):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4194304)
+    sock.bind(('127.0.0.1', port))
+    sock.settimeout(0.5)
+    count = 0
+    end = None
+    while end is None or time.monotonic() < end:
+        try:
+            sock.recv(2048)
+        except socket.timeout:
+            continue
+        if end is None:
+            end = time.monotonic() + duration
+        count += 1
+    result.put(count)
+
+
+def _relay(port, destination, options):
+    logging.basicConfig(level=logging.WARNING)
+    relay = MultiThreadUDPRelay(**options)
+    relay.add_relay('127.0.0.1', port, '127.0.0.1:%d' % destination)
+    relay.run()
+
+
+def _client(port, duration):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = b'\0' * 64
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        for _ in range(100):
+            sock.sendto(payload, ('127.0.0.1', port))
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def bench(name, options, duration, clients):
+    sink_port = _free_port()
+    relay_port = _free_port()
+    result = multiprocessing.Queue()
+    sink = multiprocessing.Process(target=_sink, args=(sink_port, duration, result))
+    relay = multiprocessing.Process(target=_relay, args=(relay_port, sink_port, options), daemon=True)
+    sink.start()
+    relay.start()
+    time.sleep(0.5)
+    workers = [multiprocessing.Process(target=_client, args=(relay_port, duration + 1)) for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    count = result.get()
+    for worker in workers:
+        worker.join()
+    relay.terminate()
+    print("%-24s %10.0f packets/s" % (name, count / duration))
+
+
+if __name__ == '__main__':
+    test_duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    client_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    bench('one datagram per wakeup', {'batch': 1}, test_duration, client_count)
+    bench('drain 32 per wakeup', {'batch': 32}, test_duration, client_count)
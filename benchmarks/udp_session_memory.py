@@ -0,0 +1,71 @@
+# Measure the memory used by the udp relay session table, in bytes per session.
+#
+#   python3 benchmarks/udp_session_memory.py [sessions]
+#
+# Sockets are replaced by plain objects, so only the python side is measured.
+# The "before" table is a copy of the layout the relay used previously:
+# two _SessionPeer and one _SessionInfo for every session, keyed by
+# ((ip, port), (ip, port)) for both directions.
+import sys
+import os
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fusion_backend.modules.relay import UDPSession, _UDPRule
+
+
+class _SessionInfo(object):
+    def __init__(self):
+        self._last_update = 0.0
+        self._traffic = 0
+
+
+class _SessionPeer(object):
+    def __init__(self, destination_socket, destination_addr, info):
+        self.socket = destination_socket
+        self.address = destination_addr
+        self.session_info = info
+
+
+def _before(count, listen_sock, local_addr, destination):
+    session_list = dict()
+    for i in range(count):
+        # addresses are created per session just like recvfrom/getsockname do
+        client_addr = ('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), 10000 + i % 50000)
+        relay_local_addr = ('0.0.0.0', 20000 + i % 40000)
+        relay_sock = object()
+        info = _SessionInfo()
+        session_list[(local_addr, client_addr)] = _SessionPeer(relay_sock, destination, info)
+        session_list[(relay_local_addr, destination)] = _SessionPeer(listen_sock, client_addr, info)
+    return session_list
+
+
+def _after(count, listen_sock, local_addr, destination):
+    table = UDPSession()
+    # sessions share the rule which created them
+    rule = _UDPRule(1234, None, 5.0)
+    for i in range(count):
+        client_addr = ('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), 10000 + i % 50000)
+        # every client has its own ip, so each session also pays for a traffic counter
+        table.create_session(listen_sock, client_addr, object(), destination, rule, 0.0, [0, 0, 1])
+    return table
+
+
+def measure(name, build, count):
+    listen_sock = object()
+    local_addr = ('0.0.0.0', 1234)
+    destination = ('127.0.0.1', 4567)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    table = build(count, listen_sock, local_addr, destination)
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    print("%-8s %8d sessions %12d bytes %8.1f bytes/session" % (name, count, used, used / count))
+    return table
+
+
+if __name__ == '__main__':
+    session_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    measure('before', _before, session_count)
+    measure('after', _after, session_count)
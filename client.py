@@ -2,27 +2,56 @@ import socket
 import threading
 import ipaddress
 import logging
-import select
+import selectors
+import time
 import json
-import asyncio
 from abc import ABCMeta
+from queue import Queue
 
-import tornado.web
-import tornado.httpserver
-import tornado.ioloop
-import tornado.gen
-from queue import Queue, Empty
+from fusion_backend import metrics
+
+
+def __getattr__(name):
+    # the http client needs tornado, which is only imported when it is used
+    if name in ('HTTPClient', 'HTTPHandler'):
+        import http_client
+        return getattr(http_client, name)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+
+_accepted_metric = metrics.counter('fusion_client_messages_total', "messages received from the controller",
+                                   result='accepted')
+
+
+def _count_error(error):
+    metrics.counter('fusion_client_messages_total', "messages received from the controller", result=error).inc()
 
 
 class Client(threading.Thread):
     def __init__(self, report_queue: Queue):
         self.__report_queue = report_queue
+        self.__module_names = None
         super(Client, self).__init__()
     
     def run(self):
         pass
 
+    def stop(self):
+        # stop listening and wait for the thread to end
+        pass
+
+    def set_module_names(self, module_names):
+        # names of loaded modules, used to tell the controller which updates can be applied
+        self.__module_names = frozenset(module_names)
+
     def report(self, raw_json):
+        data, error = self.parse(raw_json)
+        if error is None:
+            self.enqueue(data)
+
+    @staticmethod
+    def parse(raw_json):
+        # returns (data, None), or (None, error)
         try:
             json_obj = json.loads(raw_json)
             if json_obj['version'] == 1:
@@ -31,70 +60,60 @@ class Client(threading.Thread):
             else:
                 logging.warning("Invalid packer version. "
                                 "Accept packet in version 1, but received in %d" % json_obj['version'])
-        except json.JSONDecodeError:
+                _count_error("unsupported version")
+                return None, "unsupported version"
+        except (json.JSONDecodeError, UnicodeDecodeError):
             logging.error("invalid json format")
-            return
-        except KeyError:
+            _count_error("invalid json")
+            return None, "invalid json"
+        except (KeyError, TypeError):
             logging.warning("Invalid packet format!")
-            return
+            _count_error("invalid packet")
+            return None, "invalid packet"
+        if type(data) is not list:
+            logging.warning("Invalid packet format!")
+            _count_error("invalid packet")
+            return None, "invalid packet"
+        return data, None
+
+    def enqueue(self, data: list):
+        # returns the status of each module in data
+        status = {}
+        for module_data in data:
+            for module_name in (module_data.keys() if type(module_data) is dict else ()):
+                if self.__module_names is None or module_name in self.__module_names or module_name == 'Core':
+                    status[module_name] = "accepted"
+                else:
+                    status[module_name] = "unknown module"
         self.__report_queue.put(data)
+        _accepted_metric.inc()
+        return status
 
 
-class HTTPClient(Client):
-    def __init__(self, queue: Queue, conf: dict):
-        super(HTTPClient, self).__init__(queue)
-        self.__conf = conf
-        self.__application = tornado.web.Application([
-            (r'/', HTTPHandler, dict(conf=conf, reporter=self.report))
-        ])
-        self.__http_server = tornado.httpserver.HTTPServer(self.__application)
-        if type(conf['client']) is str:
-            conf['client'] = [conf['client']]
-        for client_addr in conf['client']:
-            self.__http_server.bind(self.__conf['client_port'], client_addr)
+class _TCPConnection(object):
+    __slots__ = ('sock', 'address', 'buffer', 'scanned', 'last_active')
 
-    def run(self):
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        self.__http_server.start()
-        tornado.ioloop.IOLoop.current().start()
-
-
-# noinspection PyAbstractClass
-class HTTPHandler(tornado.web.RequestHandler):
-    # conf = None
-
-    def __init__(self, application, request, **kwargs):
-        super(HTTPHandler, self).__init__(application, request, **kwargs)
-        self.conf = kwargs['conf']
-        self.reporter = kwargs['reporter']
-
-    # noinspection PyMethodOverriding
-    @tornado.gen.coroutine
-    def initialize(self, **kwargs):
-        pass
-
-    @tornado.gen.coroutine
-    def get(self, *args, **kwargs):
-        self.write("<h1>Error 418 - I'm a Teapot</h1><p>You attempt to brew coffee with a teapot.</p>")
-        self.set_status(418, "I'm a teapot")
-
-    @tornado.gen.coroutine
-    def post(self, *args, **kwargs):
-        if self.request.headers['key'] != self.conf['controller_key']:
-            logging.warning("controller key mismatch from '%s'" % self.request.remote_ip)
-        if self.request.headers['Content-Type'] == 'application/json':
-            self.reporter(self.request.body)
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.buffer = bytearray()
+        # everything before this offset is known to contain no newline
+        self.scanned = 0
+        self.last_active = time.monotonic()
 
 
 class TCPClient(Client):
+    # newline delimited Fusion-API messages from the controller
     def __init__(self, queue: Queue, conf: dict):
         super(TCPClient, self).__init__(queue)
-        self.__sock4 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__sock6 = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        self.__sock4.setblocking(False)
-        self.__sock6.setblocking(False)
-
-        self.__client_sock = []
+        self.__selector = selectors.DefaultSelector()
+        self.__max_message_size = int(conf.get('client_max_message_size', 64 * 1024 * 1024))
+        self.__idle_timeout = float(conf.get('client_idle_timeout', 300))
+        self.__recv_size = 256 * 1024
+        self.__connections = {}
+        self.__running = True
+        metrics.gauge('fusion_client_connections', "open connections from the controller",
+                      func=lambda: len(self.__connections))
 
         if type(conf['client']) is str:
             conf['client'] = [conf['client']]
@@ -106,52 +125,101 @@ class TCPClient(Client):
                 logging.error("invalid ip address '%s'" % client_addr)
                 continue
             if type(res) is ipaddress.IPv4Address:
-                self.__sock4.bind((client_addr, conf['client_port']))
-                logging.info("client server bind on %s:%d" % (client_addr, conf['client_port']))
-                self.__client_sock.append(self.__sock4)
-                self.__sock4.listen()
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             else:
-                self.__sock6.bind((client_addr, conf['client_port']))
-                logging.info("client server bind on [%s]:%d" % (client_addr, conf['client_port']))
-                self.__client_sock.append(self.__sock6)
-                self.__sock6.listen()
+                sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+                # so "::" and "0.0.0.0" can be bound at the same time
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setblocking(False)
+            try:
+                sock.bind((client_addr, conf['client_port']))
+            except OSError:
+                # release the addresses already bound
+                sock.close()
+                self.__close_all()
+                raise
+            sock.listen(128)
+            logging.info("client server bind on [%s]:%d" % (client_addr, conf['client_port']))
+            self.__selector.register(sock, selectors.EVENT_READ, self.__accept)
 
     def run(self):
-        queue_list = {}
-        while True:
-            readable, writable, exceptional = select.select(self.__client_sock, [], [], 1)
-            if readable:
-                for sock in readable:
-                    if sock is self.__sock4 or sock is self.__sock6:
-                        connection, addr = sock.accept()
-                        logging.debug("received connection from '%s'" % addr[0])
-                        connection.setblocking(False)
-                        queue_list[connection] = Queue()    # create receive buffer
-                        self.__client_sock.append(connection)   # add socket into read socket list
-
-                    else:
-                        data = sock.recv(1024)
-                        if data == b'':                     # connection closed
-                            logging.debug("connection close by client '%s'" % sock.getpeername()[0])
-                            self.__client_sock.remove(sock)
-                            del queue_list[sock]        # delete receive queue
-                        else:
-                            if b'\n' in data:
-                                # reach the end if current packet
-                                raw_json = ''
-                                while True:
-                                    try:
-                                        raw_json += queue_list[sock].get_nowait()
-                                    except Empty:
-                                        break
-                                mess = data.split(b'\n')
-                                raw_json += mess[0]
-                                self.report(raw_json)
-
-                                if mess[-1] != b'':
-                                    queue_list[sock].put(mess[-1])
-                                for packet in mess[1:-1]:
-                                    self.report(packet)
-                            else:
-                                queue_list[sock].put(data)
-
+        next_idle_check = time.monotonic() + 1
+        while self.__running:
+            for key, mask in self.__selector.select(timeout=1):
+                key.data(key.fileobj)
+            if time.monotonic() >= next_idle_check:
+                next_idle_check = time.monotonic() + 1
+                self.__close_idle()
+        self.__close_all()
+
+    def stop(self):
+        # the selector wakes up at least once a second
+        self.__running = False
+        if self.is_alive():
+            self.join()
+
+    def __close_all(self):
+        for key in list(self.__selector.get_map().values()):
+            key.fileobj.close()
+        self.__selector.close()
+        self.__connections.clear()
+
+    def __accept(self, sock: socket.socket):
+        for _ in range(64):
+            try:
+                connection, addr = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.warning("failed to accept controller connection: %s" % str(e))
+                return
+            logging.debug("received connection from '%s'" % addr[0])
+            connection.setblocking(False)
+            self.__connections[connection] = _TCPConnection(connection, addr)
+            self.__selector.register(connection, selectors.EVENT_READ, self.__receive)
+
+    def __receive(self, sock: socket.socket):
+        connection = self.__connections[sock]
+        try:
+            data = sock.recv(self.__recv_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logging.debug("connection error from client '%s' (%s)" % (connection.address[0], str(e)))
+            self.__close(connection)
+            return
+        if data == b'':                     # connection closed
+            logging.debug("connection close by client '%s'" % connection.address[0])
+            self.__close(connection)
+            return
+        connection.last_active = time.monotonic()
+        buffer = connection.buffer
+        buffer += data
+        # only the new data is scanned, so a big message is not scanned again for every chunk
+        start = 0
+        end = buffer.find(b'\n', connection.scanned)
+        while end >= 0:
+            if end > start:
+                self.report(bytes(buffer[start:end]))
+            start = end + 1
+            end = buffer.find(b'\n', start)
+        if start:
+            del buffer[:start]
+        connection.scanned = len(buffer)
+        if len(buffer) > self.__max_message_size:
+            logging.warning("message from client '%s' is larger than %d bytes, connection closed" %
+                            (connection.address[0], self.__max_message_size))
+            self.__close(connection)
+
+    def __close_idle(self):
+        deadline = time.monotonic() - self.__idle_timeout
+        for connection in [connection for connection in self.__connections.values()
+                           if connection.last_active < deadline]:
+            logging.debug("close idle connection from client '%s'" % connection.address[0])
+            self.__close(connection)
+
+    def __close(self, connection: _TCPConnection):
+        self.__selector.unregister(connection.sock)
+        del self.__connections[connection.sock]
+        connection.sock.close()
@@ -1,36 +1,91 @@
 import json
+import gzip
 import logging
 import importlib
 import threading
-import requests
+import time
+import sys
+import os
+import concurrent.futures
 import json
-from queue import Queue
+from queue import Queue, Empty
+try:
+    import zstandard
+except ImportError:
+    pass
+try:
+    import msgpack
+except ImportError:
+    pass
 
 import client
+from fusion_backend import uplink
+from fusion_backend import spool
+from fusion_backend import delta
+from fusion_backend import dispatch
+from fusion_backend import metrics
 
 
 _logger = logging.getLogger('Core')
 
+# configuration keys used by the reporter and by the client, changing them rebuilds that part
+_REPORT_KEYS = ('controller', 'controller_port', 'controller_protocol', 'controller_key', 'controller_timeout', 'node',
+                'compression', 'compress_threshold', 'report_format', 'report_encoding', 'delta_full_interval',
+                'heartbeat_interval', 'reconnect_max_interval', 'controller_buffer')
+_CLIENT_KEYS = ('client', 'client_port', 'client_protocol', 'controller_key', 'client_max_message_size',
+                'client_idle_timeout', 'client_workers', 'metrics')
+_REQUIRED_KEYS = ('controller', 'node', 'controller_protocol', 'client_protocol', 'module')
+
+# asks the reporter to rebuild the connection to the controller
+_RECONFIGURE = object()
+
 
 class Core:
 
     def __init__(self, config_filename="config.json"):
         self.__config_filename = config_filename
         self.__config_raw_json = None
+        # configuration the reporter is built with
+        self.__report_conf = None
         self.__module_queue = Queue()
         self.__receive_queue = Queue()
         self.__report_thread = threading.Thread(target=self.__reporter)
         self.__dispatch_thread = threading.Thread(target=self.__dispatch)
         self.__do_report = None
         self.__module_list = {}
+        # key in configuration -> module name
+        self.__module_keys = {}
+        # module name -> worker applying its updates
+        self.__workers = {}
         self.__client_instance = None
+        self.__http_session = None
+        self.__http_timeout = None
+        self.__compress = None
+        self.__compress_threshold = 0
+        self.__serialize = None
+        self.__delta_encoder = None
+        self.__tcp_uplink = None
+        self.__spool = None
+        self.__spool_retry_interval = None
+        # seconds spent in each startup phase, and in loading and starting each module
+        self.__startup_time = None
+        self.__startup_phases = {}
+        self.__startup_modules = {}
+        metrics.gauge('fusion_report_queue_depth', "reports waiting to be sent to the controller",
+                      func=self.__module_queue.qsize)
+        metrics.gauge('fusion_receive_queue_depth', "controller messages waiting to be dispatched",
+                      func=self.__receive_queue.qsize)
+        self.__report_metric = metrics.histogram('fusion_report_seconds', "time to send a batch to the controller")
+        self.__sent_metric = metrics.counter('fusion_reports_total', "batches sent to the controller", result='sent')
+        self.__failed_metric = metrics.counter('fusion_reports_total', "batches sent to the controller",
+                                               result='failed')
 
     def get_config_filename(self):
         return self.__config_filename
 
     def load(self):
-        with open(self.__config_filename, 'r') as file_handle:
-            self.__config_raw_json = json.load(file_handle)
+        self.__startup_time = phase_start = time.monotonic()
+        self.__config_raw_json = self.__read_config()
 
         if "controller" not in self.__config_raw_json:
             _logger.error("no controller address")
@@ -40,55 +95,274 @@ class Core:
             _logger.error("node id not set")
             exit(0)
 
-        _logger.debug("initializing client service...")
-        # initialize client
-        self.__client_instance = getattr(client, '%sClient' % self.__config_raw_json['client_protocol'].upper())(
-            self.__receive_queue, self.__config_raw_json
-        )
-        self.__client_instance.start()
-        _logger.debug("client started with protocol '%s'" % self.__config_raw_json['client_protocol'].upper())
+        phase_start = self.__end_phase('config', phase_start)
+        self.__client_instance = self.__start_client(self.__config_raw_json)
+        phase_start = self.__end_phase('client', phase_start)
+        self.__init_report(self.__config_raw_json)
+        phase_start = self.__end_phase('report', phase_start)
 
-        # initialize report method based on report protocol
-        self.__do_report = getattr(self, "_%s_report" % self.__config_raw_json['controller_protocol'])
+        # reports which could not be sent are kept on disk until the controller is back
+        spool_conf = self.__config_raw_json.get('spool', {})
+        if spool_conf is not False:
+            spool_path = spool_conf.get('path', os.path.join(os.path.dirname(os.path.abspath(self.__config_filename)),
+                                                             'spool'))
+            self.__spool = spool.Spool(spool_path, spool_conf.get('max_size', 64 * 1024 * 1024),
+                                       spool_conf.get('segment_size', 4 * 1024 * 1024),
+                                       spool_conf.get('fsync', True))
+            self.__spool_retry_interval = float(spool_conf.get('retry_interval', 10))
+            metrics.gauge('fusion_spool_bytes', "reports waiting in the spool", func=lambda: self.__spool.size)
+        phase_start = self.__end_phase('spool', phase_start)
 
         if type(self.__config_raw_json['module']) is dict:
-            for module_name, module_config in self.__config_raw_json['module'].items():
-                module_name = module_name.replace('-', '_')
-                try:
-                    module_meta = importlib.import_module(__package__+".modules."+module_name)
-                except ImportError:
-                    _logger.warning("module '%s' not found." % module_name)
-                    continue
-                module = getattr(module_meta, 'get_module')(self.__module_queue, module_config)
-                if module is None:
-                    _logger.warning("failed to load '%s'" % module_name)
-                else:
-                    self.__module_list[module.__class__.__name__] = module
-                    _logger.info("module %s loaded" % module.__class__.__name__)
+            # modules are constructed at the same time, and registered in the order of the configuration
+            modules = self.__config_raw_json['module']
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(modules), 1)) as executor:
+                futures = [(module_key, executor.submit(self.__construct_module, module_key, module_config))
+                           for module_key, module_config in modules.items()]
+                for module_key, future in futures:
+                    module, elapsed = future.result()
+                    if module is not None:
+                        self.__register_module(module_key, module)
+                        self.__startup_modules[module.__class__.__name__] = {'load': elapsed}
             _logger.info("%d module(s) loaded" % len(self.__module_list))
+            self.__client_instance.set_module_names(self.__module_list.keys())
         else:
             _logger.error("invalid module configuration")
             exit(0)
+        self.__end_phase('load', phase_start)
 
     def run(self):
+        phase_start = time.monotonic()
+        for worker in self.__workers.values():
+            worker.start()
         self.__dispatch_thread.setDaemon(True)
         self.__dispatch_thread.start()
+        dispatch_stat_thread = threading.Thread(target=self.__report_dispatch_statistic)
+        dispatch_stat_thread.setDaemon(True)
+        dispatch_stat_thread.start()
+        metrics_thread = threading.Thread(target=self.__report_metrics)
+        metrics_thread.setDaemon(True)
+        metrics_thread.start()
 
         # start reporter
+        if self.__tcp_uplink is not None:
+            self.__tcp_uplink.start()
         self.__report_thread.setDaemon(True)
         self.__report_thread.start()
+        phase_start = self.__end_phase('threads', phase_start)
+
+        # a slow module, like one waiting for its server process, does not delay the others
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.__module_list), 1)) as executor:
+            for module_name, (elapsed, ready) in zip(self.__module_list,
+                                                     executor.map(self.__start_and_wait,
+                                                                  self.__module_list.values())):
+                self.__startup_modules[module_name].update({'start': elapsed, 'ready': ready})
+        self.__end_phase('start', phase_start)
+        self.__report_startup()
 
-        for module_name in self.__module_list:
-            self.__module_list[module_name].start()
+    def __end_phase(self, phase, phase_start):
+        now = time.monotonic()
+        self.__startup_phases[phase] = round(now - phase_start, 3)
+        return now
+
+    def __report_startup(self):
+        total = round(time.monotonic() - self.__startup_time, 3)
+        _logger.info("started in %.3fs, %s" % (total, ", ".join("%s %.3fs" % item
+                                                                for item in self.__startup_phases.items())))
+        self.__module_queue.put({
+            'Core': {
+                'action': 'startup',
+                'data': {
+                    'total': total,
+                    'phases': self.__startup_phases,
+                    'modules': self.__startup_modules
+                }
+            }
+        })
+
+    def __start_and_wait(self, module):
+        # returns the seconds until the module is ready, and whether it got ready in time
+        start = time.monotonic()
+        module.start()
+        timeout = float(self.__config_raw_json.get('module_ready_timeout', 10))
+        ready = module.wait_ready(timeout)
+        if not ready:
+            _logger.warning("module %s is not ready after %.1fs" % (module.__class__.__name__, timeout))
+        return round(time.monotonic() - start, 3), ready
+
+    def __read_config(self):
+        with open(self.__config_filename, 'r') as file_handle:
+            return json.load(file_handle)
+
+    def __start_client(self, conf):
+        _logger.debug("initializing client service...")
+        # the http client module, and tornado with it, is only imported with client_protocol http
+        client_instance = getattr(client, '%sClient' % conf['client_protocol'].upper())(self.__receive_queue, conf)
+        client_instance.start()
+        _logger.debug("client started with protocol '%s'" % conf['client_protocol'].upper())
+        return client_instance
+
+    def __load_module(self, module_key, module_config):
+        module, elapsed = self.__construct_module(module_key, module_config)
+        if module is not None:
+            self.__register_module(module_key, module)
+        return module
+
+    def __construct_module(self, module_key, module_config):
+        # returns the module, or None, and the seconds spent
+        start = time.monotonic()
+        module_name = module_key.replace('-', '_')
+        try:
+            module_meta = importlib.import_module(__package__+".modules."+module_name)
+        except ImportError:
+            _logger.warning("module '%s' not found." % module_name)
+            return None, round(time.monotonic() - start, 3)
+        module = getattr(module_meta, 'get_module')(self.__module_queue, module_config)
+        if module is None:
+            _logger.warning("failed to load '%s'" % module_name)
+        return module, round(time.monotonic() - start, 3)
+
+    def __register_module(self, module_key, module):
+        self.__module_list[module.__class__.__name__] = module
+        self.__module_keys[module_key] = module.__class__.__name__
+        self.__workers[module.__class__.__name__] = self.__create_worker(module)
+        _logger.info("module %s loaded" % module.__class__.__name__)
+
+    def __init_report(self, conf):
+        # initialize report method based on report protocol
+        self.__report_conf = conf
+        self.__do_report = getattr(self, "_%s_report" % conf['controller_protocol'])
+        self.__http_session = None
+        self.__delta_encoder = None
+        self.__tcp_uplink = None
+        if conf['controller_protocol'] == 'http':
+            self.__init_http_session()
+        elif conf['controller_protocol'] == 'tcp':
+            self.__tcp_uplink = uplink.TCPUplink(conf)
+            if conf.get('report_encoding', 'full') != 'full' or conf.get('report_format', 'json') != 'json':
+                _logger.warning("report_encoding and report_format are only supported by http controller, ignored")
+
+    def __reconfigure_report(self):
+        # reports not sent by the old uplink are sent again on the new connection
+        pending = self.__tcp_uplink.stop() if self.__tcp_uplink is not None else []
+        if self.__http_session is not None:
+            self.__http_session.close()
+        self.__init_report(self.__config_raw_json)
+        if self.__tcp_uplink is not None:
+            self.__tcp_uplink.start()
+        _logger.info("reporter reconfigured for controller '%s'" % self.__report_conf['controller'])
+        for payload in pending:
+            self.__send(payload)
 
     def __reporter(self):
         while True:
-            data = [self.__module_queue.get()]
-            while not self.__module_queue.empty():
-                data.append(self.__module_queue.get_nowait())
+            # items arriving within the window after the first one are sent together
+            window = float(self.__config_raw_json.get('report_window', 0))
+            # retry the spooled reports from time to time, even if nothing new is reported
+            timeout = self.__spool_retry_interval if self.__spool is not None and self.__spool.pending else None
+            try:
+                data = [self.__module_queue.get(timeout=timeout)]
+            except Empty:
+                data = []
+            deadline = time.monotonic() + window
+            while data and data[-1] is not _RECONFIGURE:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        data.append(self.__module_queue.get(timeout=timeout))
+                    else:
+                        data.append(self.__module_queue.get_nowait())
+                except Empty:
+                    break
+            # reports queued before the change still go to the old controller
+            reconfigure = bool(data) and data[-1] is _RECONFIGURE
+            if reconfigure:
+                data.pop()
+
+            try:
+                if data:
+                    self.__send(self._get_payload(data))
+                elif not reconfigure:
+                    self.__replay()
+                if reconfigure:
+                    self.__reconfigure_report()
+            except Exception:
+                # the reporter must never stop, or reports are queued forever
+                _logger.exception("failed to report %d item(s)" % len(data))
+
+    def __send(self, payload):
+        if self.__spool is None:
+            if not self.__deliver(payload):
+                _logger.warning("report dropped")
+        elif self.__spool.pending:
+            # older reports are waiting, keep the order
+            self.__spool.append(json.dumps(payload, separators=(',', ':')).encode())
+            self.__replay()
+        elif not self.__deliver(payload):
+            self.__spool.append(json.dumps(payload, separators=(',', ':')).encode())
+
+    def __replay(self):
+        if self.__spool is None:
+            return
+        while True:
+            record = self.__spool.peek()
+            if record is None:
+                return
+            if not self.__deliver(json.loads(record.decode())):
+                return
+            self.__spool.commit()
 
-            payload = self._get_payload(data)
-            self.__do_report(payload)
+    def __deliver(self, payload):
+        start = time.monotonic()
+        delivered = self.__do_report(payload)
+        self.__report_metric.observe(time.monotonic() - start)
+        (self.__sent_metric if delivered else self.__failed_metric).inc()
+        return delivered
+
+    def __init_http_session(self):
+        # only needed by an http controller
+        import requests
+        import requests.adapters
+        # one keep-alive connection to the controller, reused by every report
+        self.__http_session = requests.Session()
+        # only failed connection attempts are retried, a request may have reached the controller otherwise
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=2)
+        self.__http_session.mount('http://', adapter)
+        self.__http_session.mount('https://', adapter)
+        self.__http_session.headers.update({
+            'key': self.__report_conf['controller_key'],
+            'Content-Type': 'application/json'
+        })
+        timeout = self.__report_conf.get('controller_timeout', [5, 30])
+        self.__http_timeout = tuple(timeout) if type(timeout) is list else timeout
+
+        self.__compress_threshold = int(self.__report_conf.get('compress_threshold', 1024))
+        compression = self.__report_conf.get('compression', 'gzip')
+        if compression == 'zstd' and "zstandard" not in sys.modules:
+            _logger.warning("failed to import module 'zstandard', you may install it by 'pip3 install zstandard'. "
+                            "use gzip instead.")
+            compression = 'gzip'
+        if compression == 'zstd':
+            compressor = zstandard.ZstdCompressor()
+            self.__compress = lambda body: (compressor.compress(body), 'zstd')
+        elif compression == 'gzip':
+            self.__compress = lambda body: (gzip.compress(body, compresslevel=6), 'gzip')
+        else:
+            self.__compress_threshold = 0
+
+        report_format = self.__report_conf.get('report_format', 'json')
+        if report_format == 'msgpack' and "msgpack" not in sys.modules:
+            _logger.warning("failed to import module 'msgpack', you may install it by 'pip3 install msgpack'. "
+                            "use json instead.")
+            report_format = 'json'
+        if report_format == 'msgpack':
+            self.__http_session.headers['Content-Type'] = 'application/msgpack'
+            self.__serialize = msgpack.packb
+        else:
+            self.__serialize = lambda payload: json.dumps(payload, separators=(',', ':')).encode()
+        # patches against acknowledged reports, a successful http response is the acknowledgement
+        if self.__report_conf.get('report_encoding', 'full') == 'delta':
+            self.__delta_encoder = delta.DeltaEncoder(self.__report_conf.get('delta_full_interval', 100))
 
     def _http_report_init(self):
         # do some initialize work...
@@ -100,28 +374,241 @@ class Core:
         self._http_report(payload)
 
     def _http_report(self, payload):
-        headers = {
-            'key': self.__config_raw_json['controller_key']
-        }
-        requests.post(self.__config_raw_json['controller'], json=payload, headers=headers)
+        import requests
+        # after a 409 the payload is encoded and sent once more, in full this time
+        for attempt in range(2):
+            body = self.__serialize(payload if self.__delta_encoder is None else self.__delta_encoder.encode(payload))
+            headers = {}
+            if self.__compress_threshold and len(body) >= self.__compress_threshold:
+                body, headers['Content-Encoding'] = self.__compress(body)
+            try:
+                response = self.__http_session.post(self.__report_conf['controller'], data=body, headers=headers,
+                                                    timeout=self.__http_timeout)
+            except requests.RequestException as e:
+                _logger.warning("failed to report to controller: %s" % str(e))
+                return False
+            if response.status_code == 409 and self.__delta_encoder is not None:
+                # the controller does not have the reports we patch, send them in full again
+                _logger.info("controller asks for full reports")
+                self.__delta_encoder.reset()
+                continue
+            if response.status_code >= 500:
+                _logger.warning("controller failed to handle the report with status %d" % response.status_code)
+                return False
+            if response.status_code >= 400:
+                # sending it again will not help. the controller did not store these reports,
+                # so the next ones are sent in full instead of patching them
+                _logger.warning("controller rejected the report with status %d" % response.status_code)
+                if self.__delta_encoder is not None:
+                    self.__delta_encoder.reset()
+                return True
+            if self.__delta_encoder is not None:
+                self.__delta_encoder.ack()
+            return True
+        # a full report should never be answered with 409
+        return False
 
     def _tcp_report(self, payload):
-        print("tcp report")
-        pass
+        # only queued here and sent by the uplink thread, reports go to the spool while the link is down
+        if self.__spool is not None and not self.__tcp_uplink.connected:
+            return False
+        self.__tcp_uplink.send(payload)
+        return True
 
     def _get_payload(self, data):
         return {
                 'version': 1,
-                'node': self.__config_raw_json['node'],
+                'node': self.__report_conf['node'],
                 'data': data
         }
 
+    def __create_worker(self, module):
+        dispatch_conf = self.__config_raw_json.get('dispatch', {})
+        module_conf = dispatch_conf.get('modules', {}).get(module.__class__.__name__, {})
+        return dispatch.ModuleWorker(module, module_conf.get('queue_size', dispatch_conf.get('queue_size', 1000)),
+                                     module_conf.get('policy', dispatch_conf.get('policy', 'block')))
+
     def __dispatch(self):
         while True:
             data = self.__receive_queue.get()
             for module_data in data:
-                module_name = list(module_data.keys())[0]  # module_data should only have
-                if module_name == 'Core':                  # one key which is the module name
-                    print("core update")
+                try:
+                    module_name = list(module_data.keys())[0]  # module_data should only have
+                except (AttributeError, IndexError):           # one key which is the module name
+                    _logger.warning("invalid update: %s" % str(module_data))
+                    continue
+                if module_name == 'Core':
+                    self.__update_core(module_data[module_name])
+                elif module_name not in self.__workers:
+                    _logger.warning("update for unknown module '%s' ignored" % module_name)
+                else:
+                    # only queued here, so a slow module does not delay the others
+                    self.__workers[module_name].put(module_data[module_name])
+
+    def __report_dispatch_statistic(self):
+        while True:
+            time.sleep(float(self.__config_raw_json.get('dispatch', {}).get('report_interval', 60)))
+            # modules may be loaded and unloaded meanwhile
+            statistic = {name: worker.get_statistic() for name, worker in list(self.__workers.items())}
+            # nothing worth a report if no update came in
+            if any(item['processed'] or item['depth'] or item['dropped'] for item in statistic.values()):
+                self.__module_queue.put({
+                    'Core': {
+                        'action': 'dispatch',
+                        'data': statistic
+                    }
+                })
+
+    def __report_metrics(self):
+        # disabled with a report_interval of 0, the endpoint of the http client works anyway
+        while True:
+            metrics_conf = self.__config_raw_json.get('metrics', {}) or {}
+            interval = float(metrics_conf.get('report_interval', 0))
+            time.sleep(interval or 10)
+            if interval:
+                self.__module_queue.put({
+                    'Core': {
+                        'action': 'metrics',
+                        'data': metrics.snapshot()
+                    }
+                })
+
+    def __update_core(self, info):
+        for change in (info if type(info) is list else [info]):
+            action = change.get('action') if type(change) is dict else None
+            if action == 'reload':
+                # the configuration file was changed
+                try:
+                    conf = self.__read_config()
+                except (OSError, ValueError) as e:
+                    _logger.error("failed to read '%s' (%s)" % (self.__config_filename, str(e)))
+                    continue
+            elif action == 'config' and type(change.get('conf')) is dict:
+                # top-level keys to replace, null removes the key
+                conf = dict(self.__config_raw_json)
+                for key, value in change['conf'].items():
+                    if value is None:
+                        conf.pop(key, None)
+                    else:
+                        conf[key] = value
+            else:
+                _logger.warning("invalid core update: %s" % str(change))
+                continue
+            self.__apply_config(action, conf)
+
+    def __apply_config(self, action, conf):
+        old_conf = self.__config_raw_json
+        for key in _REQUIRED_KEYS:
+            if key not in conf:
+                _logger.error("'%s' is missing in the new configuration, ignored" % key)
+                return
+        if type(conf['module']) is not dict:
+            _logger.error("invalid module configuration, ignored")
+            return
+        if type(conf.get('client')) is str:
+            conf['client'] = [conf['client']]
+        if conf.get('spool') != old_conf.get('spool'):
+            _logger.warning("spool configuration is applied after restart")
+            conf['spool'] = old_conf.get('spool')
+            if conf['spool'] is None:
+                del conf['spool']
+
+        # new workers are created with the new dispatch options
+        self.__config_raw_json = conf
+        result = {'started': [], 'stopped': [], 'reconfigured': [], 'restarted': [], 'failed': []}
+        self.__apply_module_config(old_conf['module'], conf['module'], result)
+        if any(conf.get(key) != old_conf.get(key) for key in _CLIENT_KEYS):
+            self.__restart_client(old_conf, conf)
+        if any(conf.get(key) != old_conf.get(key) for key in _REPORT_KEYS):
+            self.__module_queue.put(_RECONFIGURE)
+        _logger.info("configuration applied %s" % str({key: value for key, value in result.items() if value}))
+        self.__module_queue.put({
+            'Core': {
+                'action': action,
+                'data': result
+            }
+        })
+
+    def __apply_module_config(self, old_modules, modules, result):
+        # only the modules whose configuration is changed are touched
+        for module_key in list(old_modules):
+            if module_key in modules or module_key not in self.__module_keys:
+                continue
+            if self.__unload_module(module_key):
+                result['stopped'].append(module_key)
+            else:
+                modules[module_key] = old_modules[module_key]
+                result['failed'].append(module_key)
+        for module_key, module_config in list(modules.items()):
+            if module_key not in self.__module_keys:
+                # new, or failed to load before
+                if self.__start_module(module_key, module_config):
+                    result['started'].append(module_key)
+                else:
+                    result['failed'].append(module_key)
+                continue
+            if module_key in old_modules and module_config == old_modules[module_key]:
+                continue
+            module_name = self.__module_keys[module_key]
+            try:
+                # applied in order with the updates of the module
+                applied = self.__workers[module_name].submit(self.__module_list[module_name].reconfigure,
+                                                             module_config).result()
+            except Exception:
+                _logger.exception("failed to reconfigure %s" % module_name)
+                applied = False
+            if applied:
+                if old_modules.get(module_key) == module_config:
+                    # the module keeps its configuration up to date, later updates change the old object
+                    modules[module_key] = old_modules[module_key]
+                result['reconfigured'].append(module_key)
+            elif self.__unload_module(module_key):
+                if self.__start_module(module_key, module_config):
+                    result['restarted'].append(module_key)
+                else:
+                    result['failed'].append(module_key)
+            else:
+                modules[module_key] = old_modules[module_key]
+                result['failed'].append(module_key)
+
+    def __start_module(self, module_key, module_config):
+        module = self.__load_module(module_key, module_config)
+        if module is None:
+            return False
+        self.__workers[module.__class__.__name__].start()
+        self.__start_and_wait(module)
+        self.__client_instance.set_module_names(self.__module_list.keys())
+        return True
+
+    def __unload_module(self, module_key):
+        module_name = self.__module_keys[module_key]
+        try:
+            stopped = self.__workers[module_name].submit(self.__module_list[module_name].stop).result()
+        except Exception:
+            _logger.exception("failed to stop %s" % module_name)
+            stopped = False
+        if not stopped:
+            _logger.warning("module %s can not be stopped, restart the node to apply the change" % module_name)
+            return False
+        del self.__module_list[module_name]
+        del self.__module_keys[module_key]
+        self.__workers.pop(module_name).stop()
+        self.__client_instance.set_module_names(self.__module_list.keys())
+        _logger.info("module %s stopped" % module_name)
+        return True
+
+    def __restart_client(self, old_conf, conf):
+        # listeners are bound again, the old ones have to be closed first
+        self.__client_instance.stop()
+        try:
+            client_instance = self.__start_client(conf)
+        except Exception as e:
+            _logger.error("failed to start client with the new configuration (%s), keep the old one" % str(e))
+            for key in _CLIENT_KEYS:
+                if key in old_conf:
+                    conf[key] = old_conf[key]
                 else:
-                    self.__module_list[module_name].update(module_data[module_name])
+                    conf.pop(key, None)
+            client_instance = self.__start_client(conf)
+        client_instance.set_module_names(self.__module_list.keys())
+        self.__client_instance = client_instance
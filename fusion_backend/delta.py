@@ -0,0 +1,89 @@
+import copy
+import json
+
+
+class _Unpatchable(Exception):
+    pass
+
+
+def _merge_patch(base: dict, target: dict):
+    # json merge patch (rfc 7386) which turns base into target
+    patch = {}
+    for key, value in target.items():
+        if value is None:
+            # null means removal in a merge patch
+            raise _Unpatchable()
+        old = base.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            sub_patch = _merge_patch(old, value)
+            if sub_patch:
+                patch[key] = sub_patch
+        elif type(old) is not type(value) or old != value:
+            patch[key] = value
+    for key in base:
+        if key not in target:
+            patch[key] = None
+    return patch
+
+
+def _size(data):
+    return len(json.dumps(data, separators=(',', ':')))
+
+
+class DeltaEncoder(object):
+    # a report is sent as a merge patch of the last acknowledged report of the same module and action,
+    # if that is smaller than the report itself
+    def __init__(self, full_interval=100):
+        # (module name, action) -> last acknowledged report
+        self.__acked = dict()
+        self.__pending = None
+        self.__full_interval = int(full_interval)
+        self.__count = 0
+
+    def encode(self, payload: dict):
+        if self.__count >= self.__full_interval:
+            # send everything in full from time to time, so the controller never drifts away
+            self.reset()
+        snapshots = dict(self.__acked)
+        data = [self.__encode_item(item, snapshots) for item in payload['data']]
+        # only used once the controller has acknowledged this payload
+        self.__pending = snapshots
+        encoded = dict(payload)
+        encoded['version'] = 2
+        encoded['data'] = data
+        return encoded
+
+    def ack(self):
+        if self.__pending is not None:
+            self.__acked = self.__pending
+            self.__pending = None
+            self.__count += 1
+
+    def reset(self):
+        self.__acked = dict()
+        self.__pending = None
+        self.__count = 0
+
+    @staticmethod
+    def __encode_item(item, snapshots):
+        if len(item) != 1:
+            return item
+        module_name, report = next(iter(item.items()))
+        if not isinstance(report, dict):
+            return item
+        kind = (module_name, str(report.get('action')))
+        base = snapshots.get(kind)
+        # modules may reuse their report objects
+        snapshots[kind] = copy.deepcopy(report)
+        if base is None:
+            return item
+        try:
+            patch = _merge_patch(base, report)
+        except _Unpatchable:
+            return item
+        if 'action' in report:
+            # the controller finds the report to patch by the action
+            patch['action'] = report['action']
+        if _size(patch) >= _size(report):
+            return item
+        return {'patch': {module_name: patch}}
@@ -0,0 +1,132 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+from fusion_backend import metrics
+
+
+_logger = logging.getLogger('Dispatch')
+
+_POLICIES = ('block', 'drop-oldest', 'coalesce')
+
+# ends the worker once everything queued before it is done
+_STOP = object()
+
+
+def _mergeable(first, second):
+    # updates which are lists of changes can be applied in one call, calls are never merged
+    return first[0] is None and second[0] is None and type(first[1]) is list and type(second[1]) is list
+
+
+class ModuleWorker(threading.Thread):
+    # updates of one module are applied in order on its own thread, so a slow module does not delay the others
+    def __init__(self, module, size=1000, policy='block'):
+        super(ModuleWorker, self).__init__()
+        self.setDaemon(True)
+        if policy not in _POLICIES:
+            _logger.warning("unknown dispatch policy '%s' for %s, use block instead" %
+                            (policy, module.__class__.__name__))
+            policy = 'block'
+        self.__module = module
+        self.__name = module.__class__.__name__
+        self.__size = int(size)
+        self.__policy = policy
+        self.__inbox = collections.deque()
+        self.__condition = threading.Condition()
+        self.__max_depth = 0
+        self.__dropped = 0
+        self.__processed = 0
+        self.__busy_time = 0.0
+        metrics.gauge('fusion_dispatch_queue_depth', "updates queued for a module",
+                      func=lambda: len(self.__inbox), module=self.__name)
+        self.__wait_metric = metrics.histogram('fusion_dispatch_wait_seconds',
+                                               "time an update waits in the queue of a module", module=self.__name)
+        self.__update_metric = metrics.histogram('fusion_update_seconds', "time a module takes to apply an update",
+                                                 module=self.__name)
+        self.__dropped_metric = metrics.counter('fusion_dispatch_dropped_total', "updates dropped from a full queue",
+                                                module=self.__name)
+
+    def put(self, info):
+        # (function, argument, future, queued at), function None means an update
+        entry = (None, info, None, time.monotonic())
+        with self.__condition:
+            if len(self.__inbox) >= self.__size:
+                if self.__policy == 'coalesce' and _mergeable(self.__inbox[-1], entry):
+                    last = self.__inbox[-1]
+                    self.__inbox[-1] = (None, last[1] + info, None, last[3])
+                    return
+                if self.__policy == 'drop-oldest' and self.__inbox[0][0] is None:
+                    self.__inbox.popleft()
+                    self.__dropped += 1
+                    self.__dropped_metric.inc()
+                else:
+                    # the dispatcher waits, and so does the client
+                    self.__condition.wait_for(lambda: len(self.__inbox) < self.__size)
+            self.__append(entry)
+
+    def submit(self, func, *args):
+        # func is called after the updates queued before, the result is passed through the future
+        future = concurrent.futures.Future()
+        with self.__condition:
+            self.__append((func, args, future, time.monotonic()))
+        return future
+
+    def stop(self):
+        # the worker ends after the queued updates are applied
+        with self.__condition:
+            self.__append((_STOP, None, None, None))
+        metrics.remove('fusion_dispatch_queue_depth', module=self.__name)
+
+    def __append(self, entry):
+        self.__inbox.append(entry)
+        self.__max_depth = max(self.__max_depth, len(self.__inbox))
+        self.__condition.notify_all()
+
+    def get_statistic(self):
+        # counters are reset after each call
+        with self.__condition:
+            statistic = {
+                'depth': len(self.__inbox),
+                'max_depth': self.__max_depth,
+                'dropped': self.__dropped,
+                'processed': self.__processed,
+                'busy_time': round(self.__busy_time, 3)
+            }
+            self.__max_depth = len(self.__inbox)
+            self.__dropped = self.__processed = 0
+            self.__busy_time = 0.0
+        return statistic
+
+    def run(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__inbox)
+                entry = self.__inbox.popleft()
+                count = 1
+                if self.__policy == 'coalesce':
+                    while self.__inbox and _mergeable(entry, self.__inbox[0]):
+                        entry = (None, entry[1] + self.__inbox.popleft()[1], None, entry[3])
+                        count += 1
+                self.__condition.notify_all()
+            func, arg, future, queued_at = entry
+            if func is _STOP:
+                return
+            if func is not None:
+                try:
+                    future.set_result(func(*arg))
+                except Exception as e:
+                    future.set_exception(e)
+                continue
+            start = time.monotonic()
+            self.__wait_metric.observe(start - queued_at)
+            try:
+                self.__module.update(arg)
+            except Exception:
+                _logger.exception("failed to update %s" % self.__name)
+            elapsed = time.monotonic() - start
+            self.__update_metric.observe(elapsed)
+            with self.__condition:
+                self.__processed += count
+                self.__busy_time += elapsed
@@ -0,0 +1,160 @@
+import bisect
+import logging
+import threading
+
+
+_logger = logging.getLogger('Metrics')
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+# (name, labels) -> metric, in the order they are created
+_metrics = {}
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        # tuple of (label, value), sorted by label
+        self.labels = labels
+
+
+# metrics are updated without a lock, so recording costs an attribute update.
+# most of them are only updated by one thread, otherwise a rare lost increment is accepted
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, description, labels):
+        super(Counter, self).__init__(name, description, labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels):
+        super(Gauge, self).__init__(name, description, labels)
+        self.value = 0
+        # read when the metrics are collected, for values which are already kept somewhere else
+        self.func = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.func() if self.func is not None else self.value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.bounds = tuple(buckets)
+        # one more for the values above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def get(self):
+        cumulative = []
+        count = 0
+        for bucket_count in self.counts:
+            count += bucket_count
+            cumulative.append(count)
+        return {'count': count, 'sum': round(self.sum, 6), 'bounds': self.bounds, 'buckets': cumulative}
+
+
+def _get(cls, name, description, labels, **kwargs):
+    key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        with _lock:
+            metric = _metrics.get(key)
+            if metric is None:
+                metric = _metrics[key] = cls(name, description, key[1], **kwargs)
+    return metric
+
+
+def counter(name, description, **labels) -> Counter:
+    return _get(Counter, name, description, labels)
+
+
+def gauge(name, description, func=None, **labels) -> Gauge:
+    metric = _get(Gauge, name, description, labels)
+    if func is not None:
+        metric.func = func
+    return metric
+
+
+def histogram(name, description, buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+    return _get(Histogram, name, description, labels, buckets=buckets)
+
+
+def remove(name, **labels):
+    key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+    with _lock:
+        _metrics.pop(key, None)
+
+
+def _collect():
+    # (metric, value) of every metric, a gauge which fails to read is left out
+    with _lock:
+        metrics = list(_metrics.values())
+    for metric in metrics:
+        try:
+            yield metric, metric.get()
+        except Exception as e:
+            _logger.debug("failed to read %s (%s)" % (metric.name, str(e)))
+
+
+def _label_text(labels, extra=()):
+    labels = labels + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, value.replace('\\', '\\\\').replace('"', '\\"'))
+                             for label, value in labels)
+
+
+def render():
+    # prometheus text exposition format
+    lines = []
+    described = set()
+    for metric, value in sorted(_collect(), key=lambda item: item[0].name):
+        if metric.name not in described:
+            described.add(metric.name)
+            lines.append('# HELP %s %s' % (metric.name, metric.description))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        if metric.kind != 'histogram':
+            lines.append('%s%s %s' % (metric.name, _label_text(metric.labels), value))
+            continue
+        for bound, count in zip(metric.bounds + ('+Inf',), value['buckets']):
+            lines.append('%s_bucket%s %d' % (metric.name, _label_text(metric.labels, (('le', str(bound)),)), count))
+        lines.append('%s_sum%s %s' % (metric.name, _label_text(metric.labels), value['sum']))
+        lines.append('%s_count%s %d' % (metric.name, _label_text(metric.labels), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    # name -> labels in prometheus notation -> value, for reports to the controller
+    result = {}
+    for metric, value in _collect():
+        result.setdefault(metric.name, {})[_label_text(metric.labels)] = value
+    return result
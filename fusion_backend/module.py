@@ -19,6 +19,18 @@ class Module(metaclass=ABCMeta):
     def start(self):
         pass
 
+    # wait until the module is serving after start, returns False on timeout
+    def wait_ready(self, timeout: float=None):
+        return True
+
+    # 停止, returns False if the module can not be stopped
+    def stop(self):
+        return False
+
+    # apply a new configuration without restarting, returns False if a restart is needed
+    def reconfigure(self, conf: dict):
+        return False
+
     def report(self, data: dict):
         if self.__report_module_name is None:
             report_data = {
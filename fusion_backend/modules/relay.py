@@ -1,7 +1,13 @@
 import selectors
 import logging
+import collections
+import multiprocessing
+import errno
+import os
 from queue import Queue
+import queue
 import fusion_backend.module
+from fusion_backend import metrics
 import threading
 import socket
 import time
@@ -9,6 +15,22 @@ import time
 
 _logger = logging.getLogger('Relay')
 
+_SPLICE_SUPPORTED = hasattr(os, 'splice')
+_SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+_CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+# accept at most this number of connections for each readable event of a listener
+_ACCEPT_BATCH = 64
+# number of rule changes applied in one loop of a relay
+_COMMAND_BATCH = 64
+# maximum udp packet size
+_DATAGRAM_SIZE = 65535
+# statistic items which are current values instead of counters
+_GAUGE_KEYS = ('connections', 'idle', 'sessions')
+# seconds a worker process has to send its last statistic when the relay stops
+_STOP_TIMEOUT = 5
+# seconds a request waits for the relay thread to answer
+_REQUEST_TIMEOUT = 5
+
 
 def get_module(report_queue: Queue, conf: dict):
     relay = Relay(report_queue, conf)
@@ -19,6 +41,30 @@ def _format_addr(addr):
     return addr[0], addr[1]
 
 
+def _resolve(local, local_port, destination):
+    try:
+        local_addrinfo = socket.getaddrinfo(local, local_port)[0]
+    except socket.gaierror as e:
+        _logger.warning("Invalid local address:'%s:%s'(%s)" % (local, local_port, str(e)))
+        return None
+    ip, port = destination.rsplit(':', 1)
+    try:
+        destination_addrinfo = socket.getaddrinfo(ip, port)[0]
+    except socket.gaierror as e:
+        _logger.warning("invalid destination address:'%s'(%s)" % (ip, str(e)))
+        return None
+    return local_addrinfo, destination_addrinfo
+
+
+def _parse_rule(rule):
+    # a rule is either the destination address itself,
+    # or a dict with the destination address and per rule options
+    if isinstance(rule, dict):
+        options = dict(rule)
+        return options.pop('destination'), options
+    return rule, {}
+
+
 class Relay(fusion_backend.module.Module):
     def __init__(self, report_queue, conf):
         super(Relay, self).__init__(report_queue)
@@ -28,229 +74,1292 @@ class Relay(fusion_backend.module.Module):
         self.__conf = conf
         self.__port_range = (int(conf['port_begin']), int(conf['port_end']))
         self.__selector = selectors.DefaultSelector()
+        self.__instance_obj_list = {}
+        self.__instance_list = {}
+        self.__workers = []
+        self.__control_queues = []
+        self.__report_interval = int(conf.get('report_interval', 5))
+        self.__stopped = threading.Event()
+        # set once every rule is listening
+        self.__ready = threading.Event()
+        self.__ready_workers = set()
 
         _logger.debug("relay port from %d to %d" % self.__port_range)
 
-        if conf['multiprocessing'] is False:
+        multi_process = conf['multiprocessing'] is not False
+        if multi_process and not hasattr(socket, 'SO_REUSEPORT'):
+            _logger.error("SO_REUSEPORT is not supported on this platform, fall back to multi thread relay")
+            multi_process = False
+
+        if multi_process is False:
             # use multi thread instance
-            self.__instance_obj_list = {
-                'udp': MultiThreadUDPRelay(),
-                'tcp': MultiThreadsRelay()
-            }
-            self.__instance_list = {
-                'udp': threading.Thread(target=self.__instance_obj_list['udp'].run),
-                'tcp': threading.Thread(target=self.__instance_obj_list['tcp'].run)
-            }
+            self.__instance_obj_list = _create_instances(conf)
+            for types, instance in self.__instance_obj_list.items():
+                self.__instance_list[types] = threading.Thread(target=instance.run)
+            self.__stat_thread = threading.Thread(target=_report_statistic,
+                                                  args=(self.__instance_obj_list, self.__report_interval,
+                                                        self.__send_statistic, self.__stopped))
         else:
-            _logger.error("Multiple processes are not currently supported")
+            # every worker process owns a SO_REUSEPORT listener for each rule, so the kernel
+            # spreads tcp connections across the workers, and always hands the datagrams
+            # of the same udp flow to the same worker which holds its session
+            worker_count = int(conf.get('workers', multiprocessing.cpu_count()))
+            _logger.debug("relay workers: %d" % worker_count)
+            self.__stat_queue = multiprocessing.Queue()
+            self.__stat_thread = threading.Thread(target=self.__collect_statistic)
+            for index in range(worker_count):
+                control_queue = multiprocessing.Queue()
+                worker = multiprocessing.Process(target=_relay_worker,
+                                                 args=(index, self.__conf, self.__stat_queue, control_queue))
+                worker.daemon = True
+                self.__workers.append(worker)
+                self.__control_queues.append(control_queue)
+        self.__stat_thread.setDaemon(True)
 
     def start(self):
-
-        for types in self.__conf['rules'].keys():
-            for destination_specifier in self.__conf['rules'][types].keys():
-                for relay_addr in self.__conf['relay_addr']:
-                    destination = self.__conf['rules'][types][destination_specifier]
-                    self.__instance_obj_list[types].add_relay(relay_addr, destination_specifier, destination)
+        if self.__instance_obj_list:
+            _add_rules(self.__instance_obj_list, self.__conf)
 
         for instance in self.__instance_list.values():
             instance.start()
+        for worker in self.__workers:
+            worker.start()
+        self.__stat_thread.start()
+        if not self.__workers:
+            self.__ready.set()
         _logger.info("relay started")
 
-    def update(self, info: dict):
-        pass
+    def wait_ready(self, timeout: float=None):
+        return self.__ready.wait(timeout)
 
+    def stop(self):
+        # the traffic since the last report is reported before the relay is closed, none is lost on a restart
+        if self.__workers:
+            for control_queue in self.__control_queues:
+                control_queue.put(None)
+            for worker in self.__workers:
+                worker.join(_STOP_TIMEOUT)
+                if worker.is_alive():
+                    _logger.warning("relay worker did not stop in time, its last statistic is lost")
+                    worker.terminate()
+                    worker.join()
+            # queued after the last statistic of every worker, the collector stops when it gets there
+            self.__stat_queue.put((None, None))
+            self.__stat_thread.join()
+            self.__stopped.set()
+        else:
+            self.__stopped.set()
+            self.__stat_thread.join()
+            statistic = _get_statistic(self.__instance_obj_list)
+            if _statistic_changed(statistic):
+                self.__send_statistic(statistic)
+        for instance in self.__instance_obj_list.values():
+            instance.stop()
+        for instance in self.__instance_list.values():
+            instance.join()
+        _logger.info("relay stopped")
+        return True
+
+    def reconfigure(self, conf: dict):
+        # rule changes are applied like updates, anything else needs a restart
+        if {key: value for key, value in conf.items() if key != 'rules'} != \
+                {key: value for key, value in self.__conf.items() if key != 'rules'}:
+            return False
+        changes = []
+        for types in ('tcp', 'udp'):
+            old_rules = self.__conf['rules'].get(types, {})
+            new_rules = conf.get('rules', {}).get(types, {})
+            for port in old_rules:
+                if port not in new_rules:
+                    changes.append({'action': 'remove', 'conf': {'type': types, 'port': port}})
+            for port, rule in new_rules.items():
+                if old_rules.get(port) != rule:
+                    rule_conf = dict(rule) if type(rule) is dict else {'destination': rule}
+                    rule_conf.update({'type': types, 'port': port})
+                    changes.append({'action': 'add', 'conf': rule_conf})
+        self.update(changes)
+        return True
+
+    def update(self, info: list):
+        changes = []
+        for change in info:
+            try:
+                action = change['action']
+                rule_conf = change['conf']
+                types = rule_conf['type']
+                port = int(rule_conf['port'])
+            except (KeyError, TypeError, ValueError):
+                _logger.warning("invalid relay rule change: %s" % change)
+                continue
+            if action not in ('add', 'remove') or types not in ('tcp', 'udp') or \
+                    (action == 'add' and not _valid_rule(types, rule_conf)):
+                _logger.warning("invalid relay rule change: %s" % change)
+                continue
+            if not _in_port_range(self.__conf, port):
+                continue
+            changes.append(change)
+            # keep the configuration in sync with the running rules
+            rules = self.__conf['rules'].setdefault(types, {})
+            if action == 'add':
+                rules[str(port)] = _rule_of(rule_conf)
+            else:
+                rules.pop(str(port), None)
+
+        if not changes:
+            return
+        if self.__workers:
+            for control_queue in self.__control_queues:
+                control_queue.put(changes)
+        else:
+            _apply_changes(self.__instance_obj_list, self.__conf, changes)
+
+    def __send_statistic(self, statistic, index=None):
+        # metrics of worker processes only reach this process with their statistic
+        labels = {} if index is None else {'worker': index}
+        for types, item in statistic.items():
+            for direction in ('upload', 'download'):
+                metrics.counter('fusion_relay_bytes_total', "bytes relayed", protocol=types, direction=direction,
+                                **labels).inc(item[direction])
+        if 'tcp' in statistic:
+            metrics.gauge('fusion_relay_tcp_connections', "open tcp relay connections",
+                          **labels).set(statistic['tcp']['connections'])
+        if 'udp' in statistic:
+            metrics.gauge('fusion_relay_udp_sessions', "open udp relay sessions",
+                          **labels).set(statistic['udp']['sessions'])
+        data = {
+            'action': 'stat',
+            'data': statistic
+        }
+        if index is not None:
+            data['worker'] = index
+        self.report(data)
+
+    def __collect_statistic(self):
+        while not self.__stopped.is_set():
+            try:
+                index, statistic = self.__stat_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if index is None:
+                return
+            if statistic is None:
+                # the worker has bound its listeners
+                self.__ready_workers.add(index)
+                if len(self.__ready_workers) == len(self.__workers):
+                    self.__ready.set()
+                continue
+            self.__send_statistic(statistic, index)
+
+
+def _create_instances(conf, reuse_port=False):
+    return {
+        'udp': MultiThreadUDPRelay(timeout=conf.get('udp_timeout', 5), batch=int(conf.get('udp_batch', 32)),
+                                   reuse_port=reuse_port),
+        'tcp': MultiThreadsRelay(connect_timeout=conf.get('connect_timeout', 10), reuse_port=reuse_port)
+    }
+
+
+def _in_port_range(conf, port):
+    if int(conf['port_begin']) <= int(port) <= int(conf['port_end']):
+        return True
+    _logger.warning("port %s is out of the relay port range %s-%s, rule ignored" %
+                    (port, conf['port_begin'], conf['port_end']))
+    return False
+
+
+def _rule_of(rule_conf):
+    rule = {key: value for key, value in rule_conf.items() if key not in ('type', 'port')}
+    if len(rule) == 1:
+        return rule['destination']
+    return rule
 
-class UDPSession(object):
-    def __init__(self):
-        self._session_list = dict()
 
-    def get_session(self, address_pair):
-        if address_pair not in self._session_list:
+def _valid_rule(types, rule_conf):
+    # options are checked before they reach the relay threads, or the worker processes in multi-process mode
+    destination = rule_conf.get('destination')
+    if not isinstance(destination, str) or ':' not in destination:
+        return False
+    try:
+        if types == 'udp':
+            float(rule_conf.get('timeout', 0))
+        else:
+            float(rule_conf.get('connect_timeout', 0))
+            if 'pool' in rule_conf:
+                _UpstreamPool(None, 0, **rule_conf['pool'])
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _add_rules(instances, conf):
+    drain_timeout = float(conf.get('drain_timeout', 60))
+    for types in conf['rules'].keys():
+        for destination_specifier in conf['rules'][types].keys():
+            if not _in_port_range(conf, destination_specifier):
+                continue
+            for relay_addr in conf['relay_addr']:
+                destination = conf['rules'][types][destination_specifier]
+                try:
+                    instances[types].add_relay(relay_addr, destination_specifier, destination, drain_timeout)
+                except Exception as e:
+                    _logger.warning("failed to add %s relay rule for port %s (%s)" % (types, destination_specifier,
+                                                                                    str(e)))
+
+
+def _apply_changes(instances, conf, changes):
+    drain_timeout = float(conf.get('drain_timeout', 60))
+    for change in changes:
+        # a rule which can not be applied is skipped, it must not stop the relay or its worker process
+        rule_conf = change['conf']
+        instance = instances[rule_conf['type']]
+        try:
+            if change['action'] == 'add':
+                for relay_addr in conf['relay_addr']:
+                    instance.add_relay(relay_addr, rule_conf['port'], _rule_of(rule_conf), drain_timeout)
+            else:
+                instance.remove_relay(rule_conf['port'], drain_timeout)
+        except Exception as e:
+            _logger.warning("failed to apply relay rule change %s (%s)" % (change, str(e)))
+
+
+def _statistic_changed(delta):
+    # gauges alone are not worth a report
+    for key, value in delta.items():
+        if isinstance(value, dict):
+            if _statistic_changed(value):
+                return True
+        elif value and key not in _GAUGE_KEYS:
+            return True
+    return False
+
+
+def _get_statistic(instances):
+    # a relay whose thread has failed has no statistic
+    statistic = {types: instance.get_statistic() for types, instance in instances.items()}
+    return {types: item for types, item in statistic.items() if item is not None}
+
+
+def _report_statistic(instances, interval, callback, stopped: threading.Event):
+    # counters are taken and reset by the relay threads themselves,
+    # so every statistic is already the traffic since the last one
+    while not stopped.wait(interval):
+        statistic = _get_statistic(instances)
+        if _statistic_changed(statistic):
+            callback(statistic)
+
+
+def _relay_worker(index, conf, stat_queue, control_queue):
+    instances = _create_instances(conf, reuse_port=True)
+    _add_rules(instances, conf)
+    stat_queue.put((index, None))
+    for instance in instances.values():
+        instance_thread = threading.Thread(target=instance.run)
+        instance_thread.setDaemon(True)
+        instance_thread.start()
+    stopped = threading.Event()
+    stat_thread = threading.Thread(target=_report_statistic,
+                                   args=(instances, int(conf.get('report_interval', 5)),
+                                         lambda delta: stat_queue.put((index, delta)), stopped))
+    stat_thread.setDaemon(True)
+    stat_thread.start()
+    _logger.info("relay worker %d started" % index)
+    while True:
+        changes = control_queue.get()
+        if changes is None:
+            break
+        _apply_changes(instances, conf, changes)
+    # the relay is stopping, the queue is flushed when the process exits
+    stopped.set()
+    stat_thread.join()
+    statistic = _get_statistic(instances)
+    if _statistic_changed(statistic):
+        stat_queue.put((index, statistic))
+    for instance in instances.values():
+        instance.stop()
+
+
+class _CommandChannel(object):
+    # run functions in the relay thread, other threads only enqueue them
+    def __init__(self, selector: selectors.BaseSelector):
+        self._commands = collections.deque()
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+        self._signaled = False
+        # commands run at once until the relay thread is started
+        self._running = False
+        self._stopped = False
+        self._thread = None
+        self._lock = threading.Lock()
+        selector.register(self._reader, selectors.EVENT_READ, self._process)
+
+    def start(self):
+        with self._lock:
+            self._running = True
+            self._thread = threading.current_thread()
+
+    def stop(self):
+        # the relay thread is gone, rule changes left are dropped and requests are answered at once
+        with self._lock:
+            self._running = False
+            self._stopped = True
+            for func, args in self._commands:
+                if func == self._respond:
+                    func(*args)
+            self._commands.clear()
+        self._reader.close()
+        self._writer.close()
+
+    def call(self, func, *args):
+        with self._lock:
+            if self._stopped:
+                return
+            if not self._running:
+                func(*args)
+                return
+            self._commands.append((func, args))
+            if not self._signaled:
+                self._wakeup()
+
+    def request(self, func):
+        # run a function in the relay thread and wait for its result,
+        # None is returned when the relay thread has died or does not answer in time
+        result = Queue(1)
+        with self._lock:
+            if not self._running:
+                return func()
+            if not self._thread.is_alive():
+                _logger.error("relay thread is not running, request failed")
+                return None
+            self._commands.append((self._respond, (func, result)))
+            if not self._signaled:
+                self._wakeup()
+        try:
+            return result.get(timeout=_REQUEST_TIMEOUT)
+        except queue.Empty:
+            _logger.error("relay thread did not answer in %d seconds, request failed" % _REQUEST_TIMEOUT)
             return None
-        return self._session_list[address_pair]
 
-    def create_session(self, address1, socket1, address2, socket2):
-        if address1 not in self._session_list:
-            session_info = _SessionInfo()
-            self._session_list[address1] = _SessionPeer(socket2, address2[1], session_info)
-            self._session_list[address2] = _SessionPeer(socket1, address1[1], session_info)
-        return self._session_list[address1]
+    @staticmethod
+    def _respond(func, result):
+        result.put(func())
+
+    def _wakeup(self):
+        self._signaled = True
+        try:
+            self._writer.send(b'\0')
+        except BlockingIOError:
+            # the reader is not drained yet, it will wake up anyway
+            pass
 
-    def remove_session(self, address):
+    def _process(self, sock, mask):
         try:
-            del self._session_list[address]
-        except IndexError:
+            self._reader.recv(4096)
+        except BlockingIOError:
             pass
+        # clear the flag before taking commands, so a command enqueued meanwhile is never missed
+        self._signaled = False
+        # run a limited number of commands at once, so a burst does not stall forwarding
+        for _ in range(_COMMAND_BATCH):
+            if not self._commands:
+                return
+            func, args = self._commands.popleft()
+            func(*args)
+        if self._commands:
+            self._wakeup()
+
+
+class _TrafficCounter(object):
+    # traffic of a rule by client ip, connections and sessions add to their counter directly
+    def __init__(self):
+        # client ip -> [upload, download, number of connections or sessions]
+        self._clients = dict()
+
+    def acquire(self, ip):
+        counter = self._clients.get(ip)
+        if counter is None:
+            counter = self._clients[ip] = [0, 0, 0]
+        counter[2] += 1
+        return counter
+
+    @staticmethod
+    def release(counter):
+        counter[2] -= 1
+
+    def flush(self, statistic):
+        # add the traffic since last flush into statistic and reset the counters,
+        # must be called in the relay thread
+        clients = statistic['clients']
+        for ip, counter in list(self._clients.items()):
+            if counter[0] or counter[1]:
+                traffic = clients.get(ip)
+                if traffic is None:
+                    traffic = clients[ip] = {'upload': 0, 'download': 0}
+                traffic['upload'] += counter[0]
+                traffic['download'] += counter[1]
+                statistic['upload'] += counter[0]
+                statistic['download'] += counter[1]
+                counter[0] = counter[1] = 0
+            if not counter[2]:
+                del self._clients[ip]
+
+
+def _flush_traffic(rules):
+    # rules replaced on the same port are merged
+    statistic = {'upload': 0, 'download': 0, 'rules': {}}
+    for rule in rules:
+        item = statistic['rules'].get(rule.port)
+        if item is None:
+            item = {'upload': 0, 'download': 0, 'clients': {}}
+        rule.traffic.flush(item)
+        if item['clients']:
+            statistic['rules'][rule.port] = item
+    for item in statistic['rules'].values():
+        statistic['upload'] += item['upload']
+        statistic['download'] += item['download']
+    return statistic
+
+
+class _TimerWheel(object):
+    # hashed timer wheel, an item is only looked at again when its slot is due
+    def __init__(self, tick=1.0, size=512):
+        self._tick = tick
+        self._slots = [[] for _ in range(size)]
+        self._current = int(time.monotonic() / tick)
+
+    def schedule(self, item, deadline):
+        tick = -int(-deadline // self._tick)    # round up
+        # items too far in the future are rescheduled once their slot is due
+        tick = min(max(tick, self._current), self._current + len(self._slots) - 1)
+        self._slots[tick % len(self._slots)].append(item)
+
+    def advance(self, now):
+        due = []
+        end = int(now // self._tick)
+        if end - self._current >= len(self._slots):
+            self._current = end - len(self._slots) + 1
+        while self._current <= end:
+            index = self._current % len(self._slots)
+            if self._slots[index]:
+                due.extend(self._slots[index])
+                self._slots[index] = []
+            self._current += 1
+        return due
+
 
-    def get_timeout(self, timeout):
+class UDPSession(object):
+    def __init__(self):
+        # client address -> session, one table for each listening socket
+        self._client_sessions = dict()
+        # every socket created for the destination belongs to exactly one session
+        self._relay_sessions = dict()
+        self._wheel = _TimerWheel()
+
+    def __len__(self):
+        return len(self._relay_sessions)
+
+    def get_client_table(self, sock: socket.socket):
+        table = self._client_sessions.get(sock)
+        if table is None:
+            table = self._client_sessions[sock] = dict()
+        return table
+
+    def remove_client_table(self, sock: socket.socket):
+        self._client_sessions.pop(sock, None)
+
+    def get_relay_session(self, sock: socket.socket):
+        return self._relay_sessions.get(sock)
+
+    def get_sessions(self):
+        return list(self._relay_sessions.values())
+
+    def create_session(self, client_sock, client_addr, relay_sock, destination_addr, rule, now, counter):
+        session = _Session(client_sock, client_addr, relay_sock, destination_addr, rule, now, counter)
+        # the key is the address tuple stored in the session, so it costs no extra memory
+        self.get_client_table(client_sock)[client_addr] = session
+        self._relay_sessions[relay_sock] = session
+        self._wheel.schedule(session, now + rule.timeout)
+        return session
+
+    def remove_session(self, session):
+        self.get_client_table(session.client_sock).pop(session.client_addr, None)
+        self._relay_sessions.pop(session.relay_sock, None)
+
+    def get_timeout(self, now):
         expired_session_list = []
-        expire_time = time.time() - timeout
-        for addr in self._session_list:
-            session = self._session_list[addr]
-            session: _SessionPeer
-            if session.session_info.last_update < expire_time:
-                expired_session_list.append(addr)
-                print("session expired:", addr)
+        for session in self._wheel.advance(now):
+            session: _Session
+            if session.relay_sock not in self._relay_sessions:
+                # already removed
+                continue
+            deadline = session.last_update + session.rule.timeout
+            if deadline <= now:
+                expired_session_list.append(session)
+            else:
+                # touched after it was scheduled, check it again later
+                self._wheel.schedule(session, deadline)
         return expired_session_list
 
 
-class _SessionInfo(object):
-    def __init__(self):
-        self._last_update = time.time()
-        self._traffic = 0
+class _Session(object):
+    __slots__ = ('client_sock', 'client_addr', 'relay_sock', 'destination_addr',
+                 'rule', 'last_update', 'counter')
 
-    @property
-    def last_update(self):
-        return self._last_update
+    def __init__(self, client_sock, client_addr, relay_sock, destination_addr, rule, now, counter):
+        self.client_sock = client_sock
+        self.client_addr = client_addr
+        self.relay_sock = relay_sock
+        self.destination_addr = destination_addr
+        # the rule which created the session, a listener can be passed on to the rule which replaces it
+        self.rule = rule
+        self.last_update = now
+        # traffic counter of the client ip, shared with other sessions of the same client
+        self.counter = counter
 
-    def get_statistic(self, reset=False):
-        statistic = self._traffic
-        if reset:
-            self._traffic = 0
-        return statistic
 
-    def update(self, traffic):
-        self._last_update = time.time()
-        self._traffic += traffic
+class _DatagramIO(object):
+    # drain a socket with recvfrom_into over reusable buffers
+    def __init__(self, batch=32):
+        self._views = [memoryview(bytearray(_DATAGRAM_SIZE)) for _ in range(batch)]
 
+    def recv(self, sock: socket.socket):
+        # the returned data is only valid until the next call
+        result = []
+        for view in self._views:
+            try:
+                length, addr = sock.recvfrom_into(view)
+            except OSError:
+                # nothing left, or an error reported for an earlier datagram, which is taken from the socket
+                break
+            result.append((view[:length], addr))
+        return result
 
-class _SessionPeer(object):
-    def __init__(self, destination_socket: socket.socket, destination_addr, info: _SessionInfo):
-        self.socket = destination_socket
-        self.address = destination_addr
-        self.session_info = info
+    def send(self, sock: socket.socket, data, addr):
+        try:
+            sock.sendto(data, addr)
+        except OSError:
+            # socket buffer is full, or the destination can not be reached or is not allowed,
+            # drop the datagram just like the network does
+            pass
+
+
+class _UDPRule(object):
+    def __init__(self, port, destination_addrinfo, timeout):
+        self.port = port
+        self.destination_addrinfo = destination_addrinfo
+        self.timeout = timeout
+        # local address -> listening socket
+        self.listeners = dict()
+        self.drain_deadline = None
+        self.traffic = _TrafficCounter()
 
 
 class MultiThreadUDPRelay(object):
-    def __init__(self):
+    def __init__(self, timeout=5, batch=32, reuse_port=False):
         self.__selector = selectors.DefaultSelector()
-        self._sock_to_destination = dict()
+        self.__reuse_port = reuse_port
+        self.__commands = _CommandChannel(self.__selector)
+        # local port -> rule
+        self._rules = dict()
+        # listening socket -> rule
+        self._listeners = dict()
+        # removed rules which still have sessions
+        self._draining = []
+        # finding the sessions of a draining rule walks its listeners, so it is only done once a second
+        self._next_drain_check = 0
+        # closed rules whose traffic is not reported yet
+        self._retired = []
         self._session = UDPSession()
+        self._timeout = float(timeout)
+        # refreshed once per loop instead of calling time for every datagram
+        self._now = time.monotonic()
+        self._loop_metric = metrics.histogram('fusion_relay_loop_seconds',
+                                              "time a relay thread spends on the events of one select", protocol='udp')
+        self._io = _DatagramIO(batch)
+        self._running = True
 
-    def add_relay(self, local, local_port, destination: str):
-        try:
-            local_addrinfo = socket.getaddrinfo(local, local_port)[0]
-        except socket.gaierror as e:
-            _logger.warning("Invalid local address:'%s:%s'(%s)" % (local, local_port, str(e)))
+    def get_statistic(self):
+        # traffic since the last call
+        return self.__commands.request(self._flush_statistic)
+
+    def _flush_statistic(self):
+        statistic = _flush_traffic(list(self._rules.values()) + self._draining + self._retired)
+        self._retired = []
+        statistic['sessions'] = len(self._session)
+        return statistic
+
+    def add_relay(self, local, local_port, destination, drain_timeout=60):
+        # address resolving is done by the caller, the listener is created in the relay thread
+        # drain_timeout applies to the sessions of the rule this one replaces
+        destination, options = _parse_rule(destination)
+        addrinfo = _resolve(local, local_port, destination)
+        if addrinfo is None:
             return
-        ip, port = destination.rsplit(':')
-        try:
-            destination_addrinfo = socket.getaddrinfo(ip, port)[0]
-        except socket.gaierror as e:
-            _logger.warning("invalid destination address:'%s'(%s)" % (ip, str(e)))
+        self.__commands.call(self._add_listener, str(local_port), addrinfo[0], addrinfo[1],
+                             float(options.get('timeout', self._timeout)), drain_timeout)
+
+    def remove_relay(self, local_port, drain_timeout=60):
+        self.__commands.call(self._remove_rule, str(local_port), drain_timeout)
+
+    def stop(self):
+        self.__commands.call(self._stop)
+
+    def _stop(self):
+        # sockets are closed once the loop is left
+        self._running = False
+
+    def _close(self):
+        self._clear(self._session.get_sessions())
+        for sock in list(self._listeners):
+            self.__selector.unregister(sock)
+            self._session.remove_client_table(sock)
+            sock.close()
+        self._listeners.clear()
+        self._rules.clear()
+        self._draining = []
+        self.__selector.close()
+
+    def _add_listener(self, port, local_addrinfo, destination_addrinfo, timeout, drain_timeout):
+        rule = self._rules.get(port)
+        if rule is not None and (rule.destination_addrinfo[4] != destination_addrinfo[4] or rule.timeout != timeout):
+            # the rule is changed, new datagrams go to the new rule
+            self._remove_rule(port, drain_timeout)
+            rule = None
+        if rule is None:
+            rule = self._rules[port] = _UDPRule(port, destination_addrinfo, timeout)
+        if local_addrinfo[4] in rule.listeners:
             return
         _logger.info("Add UDP relay: %s:%d <=> %s:%d" % (_format_addr(local_addrinfo[4]) +
                                                          _format_addr(destination_addrinfo[4])))
-        sock = socket.socket(local_addrinfo[0], socket.SOCK_DGRAM)
-        sock.bind(local_addrinfo[4])
-        self._sock_to_destination[sock] = destination_addrinfo
-        self.__selector.register(sock, selectors.EVENT_READ, self._recv)
-
-    def _recv(self, sock: socket.socket, mask):
-        local_addr = sock.getsockname()
-        data, addr = sock.recvfrom(65535)       # maximum udp packet size
-        session = self._session.get_session((local_addr, addr))
-        session: _SessionPeer
-        # check if the session exist
-        if session is None:
-            _logger.info("new session from [%s]:%d" % (addr[0], addr[1]))
-            # session not exist, we should create a new relay session
-            destination_addrinfo = self._sock_to_destination[sock]
-            relay_sock = socket.socket(destination_addrinfo[0], socket.SOCK_DGRAM)
-            # send data to the destination at first,
-            # so the system will automatically bind a address for that socket
-            relay_sock.sendto(data, destination_addrinfo[4])
-            relay_local_addr = relay_sock.getsockname()
-            session = self._session.create_session((local_addr, addr), sock,
-                                                   (relay_local_addr, destination_addrinfo[4]), relay_sock)
-            self.__selector.register(relay_sock, selectors.EVENT_READ, self._recv)
-            _logger.info("udp session created: [%s]:%d,[%s]:%d <> [%s]:%d,[%s]:%d" %
-                         (MultiThreadUDPRelay._format_addr(addr) +
-                          MultiThreadUDPRelay._format_addr(local_addr) +
-                          MultiThreadUDPRelay._format_addr(relay_local_addr) +
-                          MultiThreadUDPRelay._format_addr(destination_addrinfo[4])))
-        else:
-            session.socket.sendto(data, session.address)
+        sock = self._take_listener(port, local_addrinfo[4])
+        if sock is None:
+            sock = socket.socket(local_addrinfo[0], socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            if self.__reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            try:
+                sock.bind(local_addrinfo[4])
+            except OSError as e:
+                _logger.warning("failed to bind udp relay on [%s]:%d (%s)" %
+                                (_format_addr(local_addrinfo[4]) + (str(e),)))
+                sock.close()
+                return
+            self.__selector.register(sock, selectors.EVENT_READ, self._recv_client)
+        rule.listeners[local_addrinfo[4]] = sock
+        self._listeners[sock] = rule
 
-        session.session_info.update(len(data))
+    def _take_listener(self, port, local_addr):
+        # the listener of a draining rule on the same port and address, binding another socket would fail,
+        # or with SO_REUSEPORT share the datagrams of new clients with the draining rule, which drops them.
+        # sessions of the draining rule keep their relay socket and destination
+        for rule in reversed(self._draining):
+            sock = rule.listeners.get(local_addr)
+            if rule.port == port and sock is not None and self._listeners.get(sock) is rule:
+                return sock
+        return None
 
-    def _clear(self, expired_list):
-        for addr in expired_list:
-            sock = self._session.get_session(addr).socket
-            if sock not in self._sock_to_destination:
-                _logger.info("close socket: %s:%d" % sock.getsockname())
+    def _remove_rule(self, port, drain_timeout):
+        rule = self._rules.pop(port, None)
+        if rule is None:
+            return
+        _logger.info("Remove UDP relay on port %s" % port)
+        # listeners are kept to deliver the datagrams of existing sessions,
+        # but no more session is created
+        rule.drain_deadline = time.monotonic() + drain_timeout
+        self._draining.append(rule)
+
+    def _check_draining(self):
+        if self._now < self._next_drain_check:
+            return
+        self._next_drain_check = self._now + 1
+        for rule in list(self._draining):
+            rule: _UDPRule
+            sessions = [session for sock in rule.listeners.values()
+                        for session in self._session.get_client_table(sock).values() if session.rule is rule]
+            if sessions and rule.drain_deadline > self._now:
+                continue
+            self._clear(sessions)
+            for sock in rule.listeners.values():
+                if self._listeners.get(sock) is not rule:
+                    # taken over by the rule which replaced this one
+                    continue
+                # sessions of older rules which passed this listener on can not reach their client any more
+                self._clear(list(self._session.get_client_table(sock).values()))
                 self.__selector.unregister(sock)
+                self._session.remove_client_table(sock)
+                del self._listeners[sock]
                 sock.close()
-            self._session.remove_session(addr)
+            self._draining.remove(rule)
+            self._retired.append(rule)
+            _logger.info("UDP relay on port %s closed" % rule.port)
+
+    def _recv_client(self, sock: socket.socket, mask):
+        # datagrams from clients to a listening socket
+        table = self._session.get_client_table(sock)
+        rule = self._listeners[sock]
+        now = self._now
+        for data, addr in self._io.recv(sock):
+            session = table.get(addr)
+            # check if the session exist
+            if session is None:
+                if rule.drain_deadline is not None:
+                    # the rule is removed
+                    continue
+                session = self._create_session(sock, rule, data, addr)
+            else:
+                self._io.send(session.relay_sock, data, session.destination_addr)
+            session.last_update = now
+            session.counter[0] += len(data)
+
+    def _recv_relay(self, sock: socket.socket, mask):
+        # datagrams from the destination to the socket of a session
+        session = self._session.get_relay_session(sock)
+        if session is None:
+            return
+        now = self._now
+        for data, addr in self._io.recv(sock):
+            if addr != session.destination_addr:
+                # not from the destination, drop it
+                continue
+            self._io.send(session.client_sock, data, session.client_addr)
+            session.last_update = now
+            session.counter[1] += len(data)
+
+    def _create_session(self, sock: socket.socket, rule: _UDPRule, data, addr):
+        _logger.info("new session from [%s]:%d" % (addr[0], addr[1]))
+        # session not exist, we should create a new relay session
+        destination_addrinfo = rule.destination_addrinfo
+        relay_sock = socket.socket(destination_addrinfo[0], socket.SOCK_DGRAM)
+        relay_sock.setblocking(False)
+        # send data to the destination at first,
+        # so the system will automatically bind a address for that socket
+        self._io.send(relay_sock, data, destination_addrinfo[4])
+        session = self._session.create_session(sock, addr, relay_sock, destination_addrinfo[4],
+                                               rule, self._now, rule.traffic.acquire(addr[0]))
+        self.__selector.register(relay_sock, selectors.EVENT_READ, self._recv_relay)
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info("udp session created: [%s]:%d,[%s]:%d <> [%s]:%d,[%s]:%d" %
+                         (_format_addr(addr) +
+                          _format_addr(sock.getsockname()) +
+                          _format_addr(relay_sock.getsockname()) +
+                          _format_addr(destination_addrinfo[4])))
+        return session
+
+    def _clear(self, expired_list):
+        for session in expired_list:
+            session: _Session
+            _logger.info("close udp session: [%s]:%d" % _format_addr(session.client_addr))
+            self.__selector.unregister(session.relay_sock)
+            session.relay_sock.close()
+            self._session.remove_session(session)
+            _TrafficCounter.release(session.counter)
 
     def run(self):
-        while True:
+        self.__commands.start()
+        while self._running:
             events = self.__selector.select(timeout=1)
+            self._now = time.monotonic()
             for key, mask in events:
                 key.data(key.fileobj, mask)
-            expired_list = self._session.get_timeout(5)
+            expired_list = self._session.get_timeout(self._now)
             if expired_list:
                 self._clear(expired_list)
+            if self._draining:
+                self._check_draining()
+            if events:
+                self._loop_metric.observe(time.monotonic() - self._now)
+        self.__commands.stop()
+        self._close()
+
+
+class _BufferPool(object):
+    # buffers of a relay thread, a connection only holds one while it has data which is not sent yet
+    def __init__(self, size=65536, max_free=64):
+        self.size = size
+        self._max_free = max_free
+        self._free = []
+
+    def get(self):
+        if self._free:
+            return self._free.pop()
+        return memoryview(bytearray(self.size))
+
+    def put(self, view: memoryview):
+        # buffers beyond max_free are left to the garbage collector after a burst
+        if len(self._free) < self._max_free:
+            self._free.append(view)
+
+
+class _BufferChannel(object):
+    # one direction of a tcp relay, data goes through a buffer taken from the pool for each read
+    def __init__(self, pool: _BufferPool):
+        self._pool = pool
+        self._view = None
+        self._send_pos = 0
+        self._length = 0
+
+    @property
+    def pending(self):
+        return self._length - self._send_pos
+
+    def fill(self, sock: socket.socket):
+        # only called when everything is sent, the peer is not read from while data is pending
+        view = self._pool.get()
+        try:
+            length = sock.recv_into(view)
+        except OSError:
+            self._pool.put(view)
+            raise
+        if not length:
+            self._pool.put(view)
+            return length
+        self._view = view
+        self._send_pos = 0
+        self._length = length
+        return length
+
+    def drain(self, sock: socket.socket):
+        # slicing a memoryview does not copy the remaining data
+        sent = sock.send(self._view[self._send_pos:self._length])
+        self._send_pos += sent
+        if self._send_pos == self._length:
+            self._release()
+        return sent
+
+    def _release(self):
+        self._pool.put(self._view)
+        self._view = None
+        self._send_pos = self._length = 0
+
+    def close(self):
+        if self._view is not None:
+            self._release()
+
+
+class _SpliceChannel(object):
+    # one direction of a tcp relay, data moves socket -> pipe -> socket inside the kernel
+    def __init__(self, pool: _BufferPool):
+        self._read_fd, self._write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        # the pool only gives the size of a read, the data never reaches a buffer
+        self._size = pool.size
+        self._pending = 0
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def fill(self, sock: socket.socket):
+        length = os.splice(sock.fileno(), self._write_fd, self._size, flags=_SPLICE_FLAGS)
+        self._pending += length
+        return length
+
+    def drain(self, sock: socket.socket):
+        sent = os.splice(self._read_fd, sock.fileno(), self._pending, flags=_SPLICE_FLAGS)
+        self._pending -= sent
+        return sent
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+_CHANNEL_TYPE = {
+    'buffer': _BufferChannel,
+    'splice': _SpliceChannel
+}
+
+
+def _is_alive(sock: socket.socket):
+    try:
+        data = sock.recv(1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    # an empty read means the connection is closed by the destination
+    return data != b''
+
+
+class _UpstreamPool(object):
+    # pre-connected sockets to the destination of a tcp rule
+    def __init__(self, destination_addrinfo, connect_timeout, min_idle=4, max_age=30):
+        self.destination_addrinfo = destination_addrinfo
+        self.connect_timeout = connect_timeout
+        self.min_idle = int(min_idle)
+        self.max_age = float(max_age)
+        self.connecting = 0
+        self.hit = 0
+        self.miss = 0
+        self.closed = False
+        self._idle = collections.deque()
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def same_as(self, other):
+        return self.min_idle == other.min_idle and self.max_age == other.max_age
+
+    def put(self, sock: socket.socket):
+        self._idle.append((sock, time.monotonic()))
+
+    def take(self):
+        now = time.monotonic()
+        while self._idle:
+            sock, created = self._idle.popleft()
+            if now - created < self.max_age and _is_alive(sock):
+                self.hit += 1
+                return sock
+            sock.close()
+        self.miss += 1
+        return None
+
+    def expire(self):
+        # drop the sockets which are too old or closed by the destination
+        now = time.monotonic()
+        idle = collections.deque()
+        for sock, created in self._idle:
+            if now - created < self.max_age and _is_alive(sock):
+                idle.append((sock, created))
+            else:
+                sock.close()
+        self._idle = idle
+
+    def get_statistic(self):
+        statistic = {
+            'hit': self.hit,
+            'miss': self.miss,
+            'idle': self.idle
+        }
+        self.hit = self.miss = 0
+        return statistic
+
+    def close(self):
+        self.closed = True
+        for sock, created in self._idle:
+            sock.close()
+        self._idle.clear()
+
+
+class _TCPRule(object):
+    def __init__(self, port, destination_addrinfo, mode, connect_timeout, pool):
+        self.port = port
+        self.destination_addrinfo = destination_addrinfo
+        self.mode = mode
+        self.channel_type = _CHANNEL_TYPE[mode]
+        self.connect_timeout = connect_timeout
+        self.pool = pool
+        # local address -> listening socket
+        self.listeners = dict()
+        # client sockets of this rule
+        self.connections = set()
+        self.drain_deadline = None
+        self.traffic = _TrafficCounter()
+
+    def same_as(self, other):
+        return (self.destination_addrinfo[4] == other.destination_addrinfo[4] and self.mode == other.mode and
+                self.connect_timeout == other.connect_timeout and
+                (self.pool is None) == (other.pool is None) and
+                (self.pool is None or self.pool.same_as(other.pool)))
 
 
 class MultiThreadsRelay(object):
-    def __init__(self):
+    def __init__(self, connect_timeout=10, reuse_port=False):
         self.__selector = selectors.DefaultSelector()
-        self.__sock_addr_map = dict()
+        self.__commands = _CommandChannel(self.__selector)
+        self.__connect_timeout = float(connect_timeout)
+        self.__loop_metric = metrics.histogram('fusion_relay_loop_seconds',
+                                               "time a relay thread spends on the events of one select",
+                                               protocol='tcp')
+        # local port -> rule
+        self.__rules = dict()
+        # listening socket -> rule
+        self.__listeners = dict()
+        # removed rules which still have connections
+        self.__draining = []
+        # closed rules whose traffic is not reported yet
+        self.__retired = []
+        self.__next_drain_check = 0
+        # upstream sockets which are still connecting, mapped to their deadline
+        self.__connecting = dict()
+        self.__next_timeout_check = 0
+        # upstream pool of each rule, keyed by local port
+        self.__pools = dict()
+        self.__pool_connecting = dict()
+        self.__next_pool_check = 0
         self.__relay_table = dict()
+        # data waiting to be sent to the socket
         self.__send_buffer = dict()
+        self.__buffers = _BufferPool()
+        self.__events = dict()
+        self.__addr_table = dict()
+        self.__reuse_port = reuse_port
+        # sockets accepted from clients mapped to their rule
+        self.__conn_rule = dict()
+        # socket -> (traffic counter of the client ip, 0 for upload or 1 for download)
+        self.__counters = dict()
+        self.__running = True
 
-    def add_relay(self, local, local_port, destination: str):
-        try:
-            local_addrinfo = socket.getaddrinfo(local, local_port)[0]
-        except socket.gaierror as e:
-            _logger.warning("Invalid local address:'%s:%s'(%s)" % (local, local_port, str(e)))
+    def get_statistic(self):
+        # traffic since the last call
+        return self.__commands.request(self._flush_statistic)
+
+    def _flush_statistic(self):
+        statistic = _flush_traffic(list(self.__rules.values()) + self.__draining + self.__retired)
+        self.__retired = []
+        statistic['connections'] = len(self.__conn_rule)
+        statistic['pool'] = {port: pool.get_statistic() for port, pool in self.__pools.items()}
+        return statistic
+
+    def add_relay(self, local, local_port, destination, drain_timeout=60):
+        # address resolving is done by the caller, the listener is created in the relay thread
+        # drain_timeout applies to the connections of the rule this one replaces
+        destination, options = _parse_rule(destination)
+        mode = options.get('mode', 'buffer')
+        if mode not in _CHANNEL_TYPE:
+            _logger.warning("unknown relay mode '%s' for port %s, use buffer instead" % (mode, local_port))
+            mode = 'buffer'
+        if mode == 'splice' and not _SPLICE_SUPPORTED:
+            _logger.warning("splice is not supported on this platform, use buffer mode for port %s" % local_port)
+            mode = 'buffer'
+        addrinfo = _resolve(local, local_port, destination)
+        if addrinfo is None:
             return
-        ip, port = destination.rsplit(':')
-        try:
-            destination_addrinfo = socket.getaddrinfo(ip, port)[0]
-        except socket.gaierror as e:
-            _logger.warning("invalid destination address:'%s'(%s)" % (ip, str(e)))
+        local_addrinfo, destination_addrinfo = addrinfo
+        connect_timeout = float(options.get('connect_timeout', self.__connect_timeout))
+        pool = None
+        if 'pool' in options:
+            pool = _UpstreamPool(destination_addrinfo, connect_timeout, **options['pool'])
+        rule = _TCPRule(str(local_port), destination_addrinfo, mode, connect_timeout, pool)
+        self.__commands.call(self._add_listener, rule, local_addrinfo, drain_timeout)
+
+    def remove_relay(self, local_port, drain_timeout=60):
+        self.__commands.call(self._remove_rule, str(local_port), drain_timeout)
+
+    def stop(self):
+        self.__commands.call(self._stop)
+
+    def _stop(self):
+        # sockets are closed once the loop is left
+        self.__running = False
+
+    def _close(self):
+        for conn in list(self.__conn_rule):
+            if conn in self.__relay_table:
+                self._clear(conn)
+        for sock in list(self.__listeners):
+            self.__selector.unregister(sock)
+            sock.close()
+        self.__listeners.clear()
+        for sock, (pool, deadline) in self.__pool_connecting.items():
+            self.__selector.unregister(sock)
+            sock.close()
+        self.__pool_connecting.clear()
+        for pool in self.__pools.values():
+            pool.close()
+        self.__pools.clear()
+        self.__rules.clear()
+        self.__draining = []
+        self.__selector.close()
+
+    def _add_listener(self, new_rule: _TCPRule, local_addrinfo, drain_timeout):
+        rule = self.__rules.get(new_rule.port)
+        if rule is not None and not rule.same_as(new_rule):
+            # the rule is changed, existing connections are drained and new ones go to the new rule
+            self._remove_rule(rule.port, drain_timeout)
+            rule = None
+        if rule is None:
+            rule = self.__rules[new_rule.port] = new_rule
+            if rule.pool is not None:
+                # listeners of the same rule on different relay address share one pool
+                self.__pools[rule.port] = rule.pool
+                self._refill(rule.pool)
+        if local_addrinfo[4] in rule.listeners:
             return
 
-        _logger.info("Add TCP relay:[%s]:%d <=> [%s]:%d" % (_format_addr(local_addrinfo[4]) +
-                                                            _format_addr(destination_addrinfo[4])))
+        _logger.info("Add TCP relay:[%s]:%d <=> [%s]:%d (%s)" % (_format_addr(local_addrinfo[4]) +
+                                                                 _format_addr(rule.destination_addrinfo[4]) +
+                                                                 (rule.mode,)))
         # create local socket
         sock = socket.socket(local_addrinfo[0], socket.SOCK_STREAM)
         sock.setblocking(False)
-        sock.bind(local_addrinfo[4])
-        sock.listen()
+        # a rule removed and added again must not fail on connections in TIME_WAIT
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.__reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            sock.bind(local_addrinfo[4])
+            sock.listen()
+        except OSError as e:
+            _logger.warning("failed to bind tcp relay on [%s]:%d (%s)" % (_format_addr(local_addrinfo[4]) + (str(e),)))
+            sock.close()
+            return
         self.__selector.register(sock, selectors.EVENT_READ, self._accept)
         # add sock into map
-        self.__sock_addr_map[sock] = destination_addrinfo
+        rule.listeners[local_addrinfo[4]] = sock
+        self.__listeners[sock] = rule
+
+    def _remove_rule(self, port, drain_timeout):
+        rule = self.__rules.pop(port, None)
+        if rule is None:
+            return
+        _logger.info("Remove TCP relay on port %s, %d connection(s) left" % (port, len(rule.connections)))
+        # stop accepting at once, existing connections are closed when they finish or after drain timeout
+        for sock in rule.listeners.values():
+            self.__selector.unregister(sock)
+            del self.__listeners[sock]
+            sock.close()
+        rule.listeners.clear()
+        if rule.pool is not None:
+            del self.__pools[port]
+            rule.pool.close()
+        if rule.connections:
+            rule.drain_deadline = time.monotonic() + drain_timeout
+            self.__draining.append(rule)
+        else:
+            self.__retired.append(rule)
+
+    def _check_draining(self):
+        now = time.monotonic()
+        if now < self.__next_drain_check:
+            return
+        self.__next_drain_check = now + 1
+        for rule in list(self.__draining):
+            rule: _TCPRule
+            if rule.connections and rule.drain_deadline > now:
+                continue
+            for conn in list(rule.connections):
+                self._clear(conn)
+            self.__draining.remove(rule)
+            self.__retired.append(rule)
+            _logger.info("TCP relay on port %s closed" % rule.port)
 
     def _accept(self, sock: socket.socket, mask):
-        conn, addr = sock.accept()
+        for _ in range(_ACCEPT_BATCH):
+            try:
+                conn, addr = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                _logger.warning("failed to accept connection: %s" % str(e))
+                return
+            self._create_relay(self.__listeners[sock], conn, addr)
+
+    def _create_relay(self, rule: _TCPRule, conn: socket.socket, addr):
+        conn.setblocking(False)
+        destination_addrinfo = rule.destination_addrinfo
+
+        destination_sock = None
+        if rule.pool is not None:
+            destination_sock = rule.pool.take()
+            self._refill(rule.pool)
 
-        # create relay socket to destination
-        destination_sock = socket.create_connection(self.__sock_addr_map[sock][4])
-        destination_sock.setblocking(False)
+        if destination_sock is None:
+            # create relay socket to destination, the connection is completed in _connected
+            destination_sock = socket.socket(destination_addrinfo[0], socket.SOCK_STREAM)
+            destination_sock.setblocking(False)
+            err = destination_sock.connect_ex(destination_addrinfo[4])
+            if err not in _CONNECT_IN_PROGRESS:
+                _logger.warning("failed to connect to [%s]:%d (%s)" %
+                                (_format_addr(destination_addrinfo[4]) + (os.strerror(err),)))
+                destination_sock.close()
+                conn.close()
+                return
+            self.__connecting[destination_sock] = time.monotonic() + rule.connect_timeout
         # add socket into relay table
         self.__relay_table[conn] = destination_sock
         self.__relay_table[destination_sock] = conn
+        self.__conn_rule[conn] = rule
+        rule.connections.add(conn)
+        counter = rule.traffic.acquire(addr[0])
+        self.__counters[conn] = (counter, 0)
+        self.__counters[destination_sock] = (counter, 1)
+        self.__addr_table[conn] = _format_addr(addr)
+        self.__addr_table[destination_sock] = _format_addr(destination_addrinfo[4])
 
-        _logger.info("create relay: [%s]:%d <=> [%s]:%d" % (_format_addr(addr) +
-                                                            _format_addr(destination_sock.getpeername())))
+        _logger.info("create relay: [%s]:%d <=> [%s]:%d" % (self.__addr_table[conn] +
+                                                            self.__addr_table[destination_sock]))
 
         # create send buffer
-        self.__send_buffer[conn] = {
-            'buffer': None,
-            'send_pos': 0
-        }
-        self.__send_buffer[destination_sock] = {
-            'buffer': None,
-            'send_pos': 0
-        }
-        # add both socket into selector
-        self.__selector.register(conn, selectors.EVENT_READ, self._relay_handle)
-        self.__selector.register(destination_sock, selectors.EVENT_READ, self._relay_handle)
+        self.__send_buffer[conn] = rule.channel_type(self.__buffers)
+        self.__send_buffer[destination_sock] = rule.channel_type(self.__buffers)
+        # add both socket into selector, data from the client is buffered until connected
+        self._update_events(conn)
+        self._update_events(destination_sock)
+
+    def _connected(self, sock: socket.socket):
+        del self.__connecting[sock]
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            _logger.warning("failed to connect to [%s]:%d (%s)" % (self.__addr_table[sock] + (os.strerror(err),)))
+            self._clear(sock)
+            return
+        _logger.debug("connected to [%s]:%d" % self.__addr_table[sock])
+        if self.__send_buffer[sock].pending:
+            self._flush(sock)
+        else:
+            self._update_events(sock)
+
+    def _check_connect_timeout(self):
+        now = time.monotonic()
+        if now < self.__next_timeout_check:
+            return
+        self.__next_timeout_check = now + 0.5
+        for sock in [sock for sock, deadline in self.__connecting.items() if deadline < now]:
+            _logger.warning("connect to [%s]:%d timeout" % self.__addr_table[sock])
+            self._clear(sock)
+
+    def _refill(self, pool: _UpstreamPool):
+        addrinfo = pool.destination_addrinfo
+        for _ in range(pool.min_idle - pool.idle - pool.connecting):
+            sock = socket.socket(addrinfo[0], socket.SOCK_STREAM)
+            sock.setblocking(False)
+            err = sock.connect_ex(addrinfo[4])
+            if err not in _CONNECT_IN_PROGRESS:
+                _logger.warning("failed to connect pool socket to [%s]:%d (%s)" %
+                                (_format_addr(addrinfo[4]) + (os.strerror(err),)))
+                sock.close()
+                return
+            pool.connecting += 1
+            self.__pool_connecting[sock] = (pool, time.monotonic() + pool.connect_timeout)
+            self.__selector.register(sock, selectors.EVENT_WRITE, self._pool_connected)
+
+    def _pool_connected(self, sock: socket.socket, mask):
+        pool, deadline = self.__pool_connecting.pop(sock)
+        self.__selector.unregister(sock)
+        pool.connecting -= 1
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if pool.closed:
+            # the rule is removed while connecting
+            sock.close()
+            return
+        if err:
+            # the pool will be refilled on next maintenance
+            _logger.debug("failed to connect pool socket to [%s]:%d (%s)" %
+                          (_format_addr(pool.destination_addrinfo[4]) + (os.strerror(err),)))
+            sock.close()
+            return
+        pool.put(sock)
+
+    def _maintain_pools(self):
+        now = time.monotonic()
+        if now < self.__next_pool_check:
+            return
+        self.__next_pool_check = now + 1
+        for sock, (pool, deadline) in list(self.__pool_connecting.items()):
+            if deadline < now:
+                self.__pool_connecting.pop(sock)
+                self.__selector.unregister(sock)
+                pool.connecting -= 1
+                sock.close()
+        for pool in self.__pools.values():
+            pool.expire()
+            self._refill(pool)
 
     def _relay_handle(self, sock, mask):
+        if sock in self.__connecting:
+            self._connected(sock)
+            return
         if mask & selectors.EVENT_READ:     # could read
             self._read(sock)
         if mask & selectors.EVENT_WRITE:
@@ -260,88 +1369,113 @@ class MultiThreadsRelay(object):
         # socket may not exist in relay table
         if sock not in self.__relay_table:
             return
-        _logger.debug("read from sock ('%s':%d)" % _format_addr(sock.getsockname()))
-        buffer = self.__send_buffer[self._peer(sock)]
-        if buffer['buffer'] is None:
-            try:
-                buffer['buffer'] = sock.recv(81920)
-                _logger.debug("actually read, length: %d" % len(buffer['buffer']))
-            except ConnectionAbortedError:
-                _logger.info("connection abort while receiving from '%s':%d" % _format_addr(sock.getsockname()))
-                buffer['buffer'] = None
-            except ConnectionResetError:
-                _logger.info("connection reset from '%s':%d" % _format_addr(sock.getsockname()))
-                buffer['buffer'] = None
-            if not buffer['buffer']:
-                _logger.debug("connection closed.")
-                buffer['buffer'] = None
-            if buffer['buffer'] is None:
-                self._clear(sock)
-                return
-            buffer['send_pos'] = 0
+        peer = self._peer(sock)
         try:
-            buffer['send_pos'] += self._peer(sock).send(buffer['buffer'][buffer['send_pos']:])
-        except (ConnectionAbortedError, ConnectionResetError):
-            _logger.info("connection abort while sending to '%s':%d" %
-                         _format_addr(self.__relay_table[sock].getpeername()))
+            length = self.__send_buffer[peer].fill(sock)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            _logger.info("connection error while receiving from [%s]:%d (%s)" %
+                         (self.__addr_table[sock] + (str(e),)))
             self._clear(sock)
             return
-        except BlockingIOError:         # send buffer is full
-            buffer['send_pos'] = 0      # so the next time we write data to buffer from position 0
-        if buffer['send_pos'] == len(buffer['buffer']):     # no more data in buffer
-            buffer['buffer'] = None
-        else:
-            # handle writable event on socket, so we can write to the socket as fast as possible
-            self.__selector.modify(self._peer(sock), selectors.EVENT_WRITE | selectors.EVENT_READ, self._relay_handle)
-        self.__send_buffer[self._peer(sock)] = buffer
+        if length == 0:
+            _logger.debug("connection closed.")
+            self._clear(sock)
+            return
+        self._flush(peer)
 
     def _write(self, sock: socket.socket):
         # socket may not exist in relay table
         if sock not in self.__relay_table:
             return
-        buffer = self.__send_buffer[sock]
-        if buffer['buffer'] is None:
+        if self.__send_buffer[sock].pending:
+            self._flush(sock)
+
+    def _flush(self, sock: socket.socket):
+        if sock in self.__connecting:
+            self._update_events(self._peer(sock))
             return
         try:
-            buffer['send_pos'] += sock.send(buffer['buffer'][buffer['send_pos']:])
-        except (ConnectionAbortedError, ConnectionResetError):
-            _logger.info("connection abort while sending to '%s':%d" % _format_addr(sock.getpeername()))
+            sent = self.__send_buffer[sock].drain(sock)
+        except BlockingIOError:         # send buffer is full
+            sent = 0
+        except OSError as e:
+            _logger.info("connection error while sending to [%s]:%d (%s)" %
+                         (self.__addr_table[sock] + (str(e),)))
             self._clear(sock)
             return
-        except BlockingIOError:         # send buffer is full
-            buffer['send_pos'] = 0
-        if buffer['send_pos'] == len(buffer['buffer']):     # no more data in buffer
-            buffer['buffer'] = None
-            self.__selector.modify(sock, selectors.EVENT_READ, self._relay_handle)
-        self.__send_buffer[sock] = buffer
+        self._count(self._peer(sock), sent)
+        # stop reading from the peer until the pending data is sent,
+        # and wait for writable event if there is something left
+        self._update_events(sock)
+        self._update_events(self._peer(sock))
 
-    def _clear(self, sock):
-        _logger.info("shutdown relay: [%s]:%d <==> [%s]:%d" % (_format_addr(sock.getpeername()) +
-                                                               _format_addr(self.__relay_table[sock].getpeername())))
-        # clear buffer first
-        del self.__send_buffer[sock]
-        del self.__send_buffer[self.__relay_table[sock]]
-
-        # unregister from selector
-        self.__selector.unregister(sock)
-        self.__selector.unregister(self.__relay_table[sock])
+    def _update_events(self, sock):
+        events = 0
+        if sock in self.__connecting:
+            # wait for the connection to complete
+            events = selectors.EVENT_WRITE
+        else:
+            if not self.__send_buffer[self._peer(sock)].pending:
+                events |= selectors.EVENT_READ
+            if self.__send_buffer[sock].pending:
+                events |= selectors.EVENT_WRITE
+        current = self.__events.get(sock, 0)
+        if events == current:
+            return
+        if current == 0:
+            self.__selector.register(sock, events, self._relay_handle)
+        elif events == 0:
+            self.__selector.unregister(sock)
+        else:
+            self.__selector.modify(sock, events, self._relay_handle)
+        self.__events[sock] = events
 
-        # close socket
-        self.__relay_table[sock].close()
-        sock.close()
+    def _count(self, source_sock, length):
+        counter, index = self.__counters[source_sock]
+        counter[index] += length
 
-        # delete from relay table
-        del self.__relay_table[self.__relay_table[sock]]
-        del self.__relay_table[sock]
+    def _clear(self, sock):
+        peer = self.__relay_table[sock]
+        _logger.info("shutdown relay: [%s]:%d <==> [%s]:%d" % (self.__addr_table[sock] + self.__addr_table[peer]))
+        for item in (sock, peer):
+            # clear buffer first
+            self.__send_buffer.pop(item).close()
+            # unregister from selector
+            if self.__events.pop(item, 0):
+                self.__selector.unregister(item)
+            # close socket
+            item.close()
+            # delete from relay table
+            self.__connecting.pop(item, None)
+            rule = self.__conn_rule.pop(item, None)
+            if rule is not None:
+                rule.connections.discard(item)
+                _TrafficCounter.release(self.__counters[item][0])
+            del self.__counters[item]
+            del self.__addr_table[item]
+            del self.__relay_table[item]
 
     def _peer(self, sock):
         return self.__relay_table[sock]
 
     def run(self):
         _logger.debug("relay instance start")
-        while True:
-            events = self.__selector.select()
+        self.__commands.start()
+        while self.__running:
+            timeout = 0.5 if self.__connecting or self.__pools or self.__draining else None
+            events = self.__selector.select(timeout=timeout)
+            start = time.monotonic()
             for key, mask in events:
                 key.data(key.fileobj, mask)
-
-
+            if self.__connecting:
+                self._check_connect_timeout()
+            if self.__pools:
+                self._maintain_pools()
+            if self.__draining:
+                self._check_draining()
+            if events:
+                self.__loop_metric.observe(time.monotonic() - start)
+        self.__commands.stop()
+        self._close()
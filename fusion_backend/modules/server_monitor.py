@@ -2,9 +2,12 @@ import logging
 import time
 import os
 import sys
+import math
+import array
 import threading
 from queue import Queue
 import fusion_backend.module
+from fusion_backend import metrics
 
 
 try:
@@ -20,6 +23,94 @@ def get_module(report_queue: Queue, conf: dict):
     return Monitor(report_queue, conf)
 
 
+# resolutions of the rollups in seconds, by the names used in the configuration and queries
+_RESOLUTIONS = {'1s': 1, '1m': 60, '5m': 300}
+
+
+def _summary(values):
+    # p95 is the nearest rank, one of the samples
+    ordered = sorted(values)
+    return {
+        'min': ordered[0],
+        'max': ordered[-1],
+        'avg': round(sum(ordered) / len(ordered), 3),
+        'p95': ordered[max(math.ceil(len(ordered) * 0.95) - 1, 0)]
+    }
+
+
+class _Ring(object):
+    # fixed number of floats, the oldest is overwritten once it is full
+    def __init__(self, size: int):
+        self.__values = array.array('d', bytes(8 * size))
+        self.__size = size
+        self.__next = 0
+        self.__length = 0
+
+    def __len__(self):
+        return self.__length
+
+    def append(self, value: float):
+        self.__values[self.__next] = value
+        self.__next = (self.__next + 1) % self.__size
+        self.__length = min(self.__length + 1, self.__size)
+
+    def last(self, count: int):
+        # the last count values, oldest first
+        count = min(count, self.__length)
+        start = (self.__next - count) % self.__size
+        if start + count <= self.__size:
+            return self.__values[start:start + count].tolist()
+        return self.__values[start:].tolist() + self.__values[:self.__next].tolist()
+
+
+class _Rollup(object):
+    # one point with min, max, avg and p95 for every period of resolution seconds
+    def __init__(self, resolution: int, size: int):
+        self.resolution = resolution
+        self.__points = {key: _Ring(size) for key in ('time', 'min', 'max', 'avg', 'p95')}
+        # the period which is being sampled, and its number of samples so far
+        self.__period = None
+        self.__samples = 0
+
+    def add(self, now: float, samples: _Ring):
+        # called after each sample was added to samples, which holds at least one period of them
+        period = int(now // self.resolution)
+        if period != self.__period and self.__samples:
+            self.__points['time'].append(self.__period * self.resolution)
+            for key, value in _summary(samples.last(self.__samples + 1)[:-1]).items():
+                self.__points[key].append(value)
+            self.__samples = 0
+        self.__period = period
+        self.__samples += 1
+
+    def points(self, count: int):
+        values = {key: ring.last(count) for key, ring in self.__points.items()}
+        return [{key: values[key][index] for key in values} for index in range(len(values['time']))]
+
+
+class _Series(object):
+    # the samples of one item, and its rollups
+    def __init__(self, size: int, rollups: dict, rollup_size: int):
+        self.samples = _Ring(size)
+        # samples since the last report
+        self.window = 0
+        self.rollups = {name: _Rollup(resolution, rollup_size) for name, resolution in rollups.items()}
+
+    def add(self, now: float, value: float):
+        self.samples.append(value)
+        self.window += 1
+        for rollup in self.rollups.values():
+            rollup.add(now, self.samples)
+
+    def summary(self):
+        # of the samples since the last report, None if there is none
+        if not self.window:
+            return None
+        summary = _summary(self.samples.last(self.window))
+        self.window = 0
+        return summary
+
+
 class Monitor(fusion_backend.module.Module):
     __last_update = 0
     __last_network_info = None
@@ -28,9 +119,28 @@ class Monitor(fusion_backend.module.Module):
         super(Monitor, self).__init__(report_queue)
         self.__report_interval = conf['interval']
         self.__report_items = conf['items']
-        self.__job = threading.Timer(self.__report_interval, self.__do_report)
+        # items are sampled more often than reported, and each report has a summary of the samples
+        self.__sample_interval = min(float(conf.get('sample_interval', self.__report_interval)),
+                                     self.__report_interval)
+        self.__rollups = {}
+        for name in conf.get('rollups', []):
+            if name not in _RESOLUTIONS:
+                logging.warning("unknown monitor rollup '%s'" % name)
+            else:
+                self.__rollups[name] = _RESOLUTIONS[name]
+        self.__rollup_size = max(int(conf.get('rollup_points', 300)), 1)
+        # enough samples for a report, and for the longest rollup period
+        longest = max([self.__report_interval] + list(self.__rollups.values()))
+        self.__sample_size = math.ceil(longest / self.__sample_interval * 1.1) + 2
+        # item name -> _Series, created with the first sample of the item
+        self.__series = {}
+        self.__lock = threading.Lock()
+        self.__job = threading.Thread(target=self.__run)
         self.__job.setDaemon(True)
         self.__task = []
+        self.__stopped = threading.Event()
+        self.__collect_metric = metrics.histogram('fusion_monitor_collect_seconds',
+                                                  "time to collect the monitor items of one sample")
 
         for task in conf['items']:
             if not hasattr(Monitor, task):
@@ -41,21 +151,85 @@ class Monitor(fusion_backend.module.Module):
                     continue
                 self.__task.append(getattr(Monitor, task))
 
-    def update(self, info: dict):
-        # not accept update
-        pass
+    def update(self, info: list):
+        for conf in info:
+            action = conf.get('action') if type(conf) is dict else None
+            if action == 'query':
+                self.__query(conf.get('conf') or {})
+            else:
+                logging.warning("unknown monitor action: %s" % str(conf))
 
-    def __do_report(self):
-        self.__job = threading.Timer(self.__report_interval, self.__do_report)
-        self.__job.start()
+    def __query(self, conf: dict):
+        # the last points of the rollup of the given resolution, for the given items or all of them
+        resolution = conf.get('resolution')
+        if resolution not in self.__rollups:
+            logging.warning("monitor rollup '%s' is not enabled" % resolution)
+            return
+        count = int(conf.get('points', self.__rollup_size))
+        with self.__lock:
+            items = conf.get('items') or list(self.__series)
+            series = {item: self.__series[item].rollups[resolution].points(count)
+                      for item in items if item in self.__series}
+        self.report({
+            'action': 'query',
+            'data': {
+                'resolution': resolution,
+                'series': series
+            }
+        })
+
+    def __run(self):
+        # samples on a fixed schedule, a slow collection skips samples instead of catching up
+        next_sample = time.monotonic() + self.__sample_interval
+        next_report = time.monotonic() + self.__report_interval
+        while not self.__stopped.wait(max(next_sample - time.monotonic(), 0)):
+            self.__do_sample()
+            now = time.monotonic()
+            next_sample = max(next_sample + self.__sample_interval, now)
+            # half a sample early, so a late sample does not push the report a whole sample back
+            if now + self.__sample_interval / 2 >= next_report:
+                self.__do_report()
+                next_report = max(next_report + self.__report_interval, now)
+
+    def __do_sample(self):
+        start = time.monotonic()
         result = {}
         for task in self.__task:
             result.update(task())
+        self.__collect_metric.observe(time.monotonic() - start)
+        now = time.time()
+        with self.__lock:
+            for item, value in result.items():
+                series = self.__series.get(item)
+                if series is None:
+                    series = self.__series[item] = _Series(self.__sample_size, self.__rollups, self.__rollup_size)
+                series.add(now, value)
+
+    def __do_report(self):
+        result = {}
+        summaries = {}
+        with self.__lock:
+            for item, series in self.__series.items():
+                summary = series.summary()
+                if summary is not None:
+                    # the last sample, which is the only one unless sample_interval is set
+                    result[item] = series.samples.last(1)[0]
+                    summaries[item] = summary
+        if self.__sample_interval < self.__report_interval:
+            # the items are the averages, as they were single samples before
+            result.update((item, summary['avg']) for item, summary in summaries.items())
+            result['summary'] = summaries
         self.report(result)
 
     def start(self):
         self.__job.start()
 
+    def stop(self):
+        self.__stopped.set()
+        if self.__job.is_alive():
+            self.__job.join()
+        return True
+
     @staticmethod
     def cpu():
         return {'cpu': psutil.cpu_percent()}
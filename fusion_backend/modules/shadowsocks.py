@@ -1,13 +1,19 @@
 import logging
 import socket
+import array
+import bisect
+import hashlib
 import multiprocessing
 import time
-import queue
+import collections
+import concurrent.futures
 import threading
 import select
+import selectors
 import sys
 import json
 import fusion_backend.module
+from fusion_backend import metrics
 try:
     import shadowsocks.manager
 except ModuleNotFoundError:
@@ -26,18 +32,168 @@ def get_module(report_queue, conf: dict):
     return manager
 
 
+# read at most this number of datagrams from the manager for each readable event
+_RECEIVE_BATCH = 64
+# the manager sends the statistic of every port at once, in datagrams of 50 ports, and an "ok" which
+# arrives while the default buffer is full of them is dropped
+_RECEIVE_BUFFER = 1 << 20
+# points of each worker on the hash ring, more points spread the ports more evenly
+_RING_REPLICAS = 160
+
+
+# the manager only answers a command with a server_port, which its own configuration does not have
+_PING = b'ping:{"server_port":0}'
+
+
+def _describe(command: bytes):
+    # for logs, without the password
+    name, _, payload = command.partition(b':')
+    try:
+        return "%s port %s" % (name.decode(), json.loads(payload.decode())['server_port'])
+    except (ValueError, KeyError, TypeError):
+        return name.decode(errors='replace')
+
+
+def _worker_address(address: str, index: int):
+    # the first worker uses the configured address, the others the next ports or a numbered socket path
+    if index == 0:
+        return address
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return "%s:%d" % (host, int(port) + index)
+    return "%s.%d" % (address, index)
+
+
+def _hash(key: str):
+    # stable across processes and restarts, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class _HashRing(object):
+    # consistent hashing, adding a worker only moves the ports which fall on its points
+    def __init__(self, names: list):
+        points = sorted((_hash("%s#%d" % (name, replica)), index)
+                        for index, name in enumerate(names) for replica in range(_RING_REPLICAS))
+        self.__points = [point for point, index in points]
+        self.__indexes = [index for point, index in points]
+
+    def get(self, port: int):
+        position = bisect.bisect(self.__points, _hash(str(port)))
+        return self.__indexes[position % len(self.__points)]
+
+
+class _TrafficAccumulator(object):
+    # traffic of each port since the last flush, in an array indexed by port instead of a dict of objects
+    def __init__(self):
+        self.__traffic = array.array('Q', bytes(8 * 65536))
+        # the ports with traffic, in the order they first had some
+        self.__ports = array.array('H')
+        # when the first of them had traffic
+        self.since = 0
+
+    def __len__(self):
+        return len(self.__ports)
+
+    def add(self, port: int, amount: int):
+        if amount <= 0:
+            return
+        if not self.__ports:
+            self.since = time.monotonic()
+        if not self.__traffic[port]:
+            self.__ports.append(port)
+        self.__traffic[port] += amount
+
+    def flush(self):
+        # returns port -> traffic since the last flush, for the ports which had any
+        traffic = {}
+        for port in self.__ports:
+            traffic[port] = self.__traffic[port]
+            self.__traffic[port] = 0
+        del self.__ports[:]
+        return traffic
+
+
+class _Worker(object):
+    # one shadowsocks manager process and its control socket
+    def __init__(self, index: int, address: str):
+        self.index = index
+        self.address = address
+        self.process = None
+        self.control_socket = None
+        self.control_addr = None
+        # taken by the control thread, and not sent yet because the socket buffer is full
+        self.outgoing = collections.deque()
+        # (command, future, sent at) waiting for an acknowledgement, in the order they were sent
+        self.pending = collections.deque()
+        # waiting for the socket to be writable
+        self.writing = False
+
+    def open(self):
+        # returns False if the address can not be used
+        if ':' in self.address:
+            host, port = self.address.rsplit(':', 1)
+            self.control_addr = host, int(port)
+            addrs = socket.getaddrinfo(host, port)
+            if addrs:
+                family = addrs[0][0]
+            else:
+                logging.error('invalid address: %s', self.address)
+                return False
+        else:
+            # unix socket
+            self.control_addr = self.address
+            family = socket.AF_UNIX
+        self.control_socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.control_socket.setblocking(False)
+        try:
+            self.control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _RECEIVE_BUFFER)
+        except OSError:
+            pass
+        if family == socket.AF_UNIX and sys.platform.startswith('linux'):
+            # the manager can only answer to a bound address, an empty one is chosen by the kernel
+            self.control_socket.bind('')
+        return True
+
+
 class ShadowsocksManager(fusion_backend.module.Module):
     def __init__(self, report_queue, conf: dict):
         super(ShadowsocksManager, self).__init__(report_queue)
         self.__config = conf
-        self.__shadowsocks_config = {}
-        self.__control_socket: socket.socket
-        self.__shadowsocks_process: multiprocessing.Process
+        self.__workers = []
         self.success = True
         self.__method_need_check = True
-        self.__user_port = dict()
-        self.__manage_send_queue = queue.Queue()
+        # port -> (method, password) of the running users
+        self.__users = dict()
         self.__worker_thread = threading.Thread(target=self.__worker)
+        self.__worker_thread.setDaemon(True)
+        self.__running = True
+        # set when the worker has ended, commands are not taken any more
+        self.__closed = False
+        # (worker, command, future) queued by other threads, the control thread is woken up through the socketpair
+        self.__commands = collections.deque()
+        self.__lock = threading.Lock()
+        self.__signaled = False
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+        self.__ack_timeout = float(conf.get('ack_timeout', 5))
+        # commands sent to a manager without an acknowledgement, so a big sync does not overflow its socket buffer
+        self.__window = max(int(conf.get('command_window', 64)), 1)
+        # traffic received from the managers and not reported yet, reported together once stat_interval
+        # seconds have passed since the first of it, or once stat_max_ports ports had traffic
+        self.__stats = _TrafficAccumulator()
+        self.__stat_interval = float(conf.get('stat_interval', 10))
+        self.__stat_max_ports = max(int(conf.get('stat_max_ports', 5000)), 1)
+        # set once every manager has answered a ping, which they must do within ready_timeout seconds
+        self.__ready = threading.Event()
+        self.__ready_timeout = float(conf.get('ready_timeout', 30))
+        metrics.gauge('fusion_shadowsocks_ports', "ports added to the shadowsocks manager",
+                      func=lambda: len(self.__users))
+        self.__stat_metric = metrics.counter('fusion_shadowsocks_stats_total', "traffic statistics from the manager")
+        self.__ack_metric = metrics.histogram('fusion_shadowsocks_ack_seconds',
+                                              "time until the manager acknowledges a command")
+        self.__ack_timeout_metric = metrics.counter('fusion_shadowsocks_ack_timeouts_total',
+                                                    "commands not acknowledged by the manager in time")
 
         # verify REQUIRED configuration first
 
@@ -45,23 +201,18 @@ class ShadowsocksManager(fusion_backend.module.Module):
             logging.error("manager_address not set for shadowsocks")
             self.success = False
             return
-        self.__control_addr = self.__config['manager_address']
-        self.__control_addr: str
-        if ':' in self.__control_addr:
-            addr = self.__control_addr.rsplit(':', 1)
-            self.__control_addr = addr[0], int(addr[1])
-            addrs = socket.getaddrinfo(addr[0], addr[1])
-            if addrs:
-                family = addrs[0][0]
-            else:
-                logging.error('invalid address: %s', self.__control_addr)
+        addresses = self.__config['manager_address']
+        if type(addresses) is not list:
+            addresses = [_worker_address(addresses, index) for index in range(max(int(conf.get('workers', 1)), 1))]
+        for index, address in enumerate(addresses):
+            worker = _Worker(index, address)
+            if not worker.open():
                 self.success = False
                 return
-        else:
-            # unix socket
-            family = socket.AF_UNIX
-        self.__control_socket = socket.socket(family, socket.SOCK_DGRAM)
-        self.__control_socket.setblocking(False)
+            self.__workers.append(worker)
+        # the address is the name of a worker on the ring, so a worker keeps its ports when others are added
+        self.__ring = _HashRing(addresses)
+        logging.debug("shadowsocks workers: %d" % len(self.__workers))
         if "server" not in self.__config:
             logging.warning("server listening address not set, use 0.0.0.0 as default")
             self.__config['server'] = '0.0.0.0'
@@ -73,75 +224,344 @@ class ShadowsocksManager(fusion_backend.module.Module):
         if "method" in self.__config:
             # this is not an error, but we should check method before add port in worker
             self.__method_need_check = False
-        self.__shadowsocks_config = {
-            "manager_address": self.__config['manager_address'],
-            "server": self.__config['server'],
-            "timeout": self.__config['timeout'],
-            "fast_open": self.__config['fast_open'],
-            "port_password": {}
-        }
-        self.__shadowsocks_process = multiprocessing.Process(target=_start_shadowsocks,
-                                                             args=(self.__shadowsocks_config,))
+        for worker in self.__workers:
+            # every manager process serves the ports hashed to it, with its own cores worth of encryption
+            shadowsocks_config = {
+                "manager_address": worker.address,
+                "server": self.__config['server'],
+                "timeout": self.__config['timeout'],
+                "fast_open": self.__config['fast_open'],
+                "port_password": {}
+            }
+            worker.process = multiprocessing.Process(target=_start_shadowsocks, args=(shadowsocks_config,))
 
     def start(self):
-        self.__shadowsocks_process.start()
-        time.sleep(1)   # just wait shadowsocks server start
-        # connect to shadowsocks manager
-        self.__control_socket.connect(self.__control_addr)
-
-        # start handling data transfer
+        for worker in self.__workers:
+            worker.process.start()
+        # start handling data transfer, once the managers answer
         self.__worker_thread.start()
 
+    def wait_ready(self, timeout: float=None):
+        return self.__ready.wait(timeout)
+
+    def stop(self):
+        self.__running = False
+        self.__wakeup()
+        if self.__worker_thread.is_alive():
+            self.__worker_thread.join()
+        for worker in self.__workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.control_socket.close()
+        self.__wakeup_reader.close()
+        self.__wakeup_writer.close()
+        logging.info("shadowsocks server stopped")
+        return True
+
+    def __send(self, worker: _Worker, command: bytes):
+        # the future is set to True once the manager acknowledges the command, or False when it does not in time
+        future = concurrent.futures.Future()
+        with self.__lock:
+            if self.__closed:
+                future.set_result(False)
+                return future
+            self.__commands.append((worker, command, future))
+            if self.__signaled:
+                return future
+            self.__signaled = True
+        self.__wakeup()
+        return future
+
+    def __wakeup(self):
+        try:
+            self.__wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def __handshake(self, worker: _Worker):
+        # ping the manager until it answers, instead of guessing how long it takes to start
+        deadline = time.monotonic() + self.__ready_timeout
+        while self.__running and worker.process.is_alive():
+            if time.monotonic() >= deadline:
+                logging.error("shadowsocks server %d did not answer in %d seconds" %
+                              (worker.index, self.__ready_timeout))
+                return False
+            try:
+                worker.control_socket.connect(worker.control_addr)
+                worker.control_socket.send(_PING)
+            except OSError:
+                # not bound yet
+                time.sleep(0.05)
+                continue
+            rlist, wlist, elist = select.select([worker.control_socket], [], [], 0.1)
+            try:
+                if rlist and worker.control_socket.recv(1506) == b'pong':
+                    return True
+            except OSError:
+                time.sleep(0.05)
+        if self.__running:
+            logging.error("shadowsocks server %d exited with code %s" % (worker.index, worker.process.exitcode))
+        return False
+
     def __worker(self):
-        while True:
-            rlist, wlist, elist = select.select([self.__control_socket], [self.__control_socket], [])
-            if rlist:
-                data = self.__control_socket.recv(1506)
-                if b'ok' == data:
-                    continue
-                if b'stat: ' in data:
-                    self.update_stat(data[6:])
-            elif wlist:
+        try:
+            self.__serve()
+        finally:
+            # nothing is sent any more, so nobody waits for an acknowledgement forever
+            with self.__lock:
+                self.__closed = True
+                commands = list(self.__commands)
+                self.__commands.clear()
+            for worker, command, future in commands:
+                future.set_result(False)
+            for worker in self.__workers:
+                for command, future in worker.outgoing:
+                    future.set_result(False)
+                for command, future, sent_at in worker.pending:
+                    future.set_result(False)
+
+    def __serve(self):
+        # the managers start at the same time, so waiting for them in turn takes as long as the slowest
+        for worker in self.__workers:
+            if not self.__handshake(worker):
+                return
+        logging.info("shadowsocks manager is ready")
+        self.__ready.set()
+        # the thread sleeps until a manager sends something, a command is queued or an acknowledgement is late
+        selector = selectors.DefaultSelector()
+        selector.register(self.__wakeup_reader, selectors.EVENT_READ)
+        for worker in self.__workers:
+            selector.register(worker.control_socket, selectors.EVENT_READ, worker)
+        while self.__running:
+            timeout = None
+            if self.__stats:
+                timeout = max(self.__stats.since + self.__stat_interval - time.monotonic(), 0)
+            for worker in self.__workers:
+                if worker.pending:
+                    deadline = max(worker.pending[0][2] + self.__ack_timeout - time.monotonic(), 0)
+                    timeout = deadline if timeout is None else min(timeout, deadline)
+            for key, mask in selector.select(timeout):
+                if key.fileobj is self.__wakeup_reader:
+                    try:
+                        self.__wakeup_reader.recv(4096)
+                    except BlockingIOError:
+                        pass
+                elif mask & selectors.EVENT_READ:
+                    self.__receive(key.data)
+            if self.__stats and (len(self.__stats) >= self.__stat_max_ports or
+                                 time.monotonic() - self.__stats.since >= self.__stat_interval):
+                self.update_stat(self.__stats.flush())
+            self.__take_commands()
+            for worker in self.__workers:
+                blocked = self.__send_commands(worker)
+                if blocked != worker.writing:
+                    # only wait for the socket to be writable while its buffer is full
+                    selector.modify(worker.control_socket,
+                                    selectors.EVENT_READ | (selectors.EVENT_WRITE if blocked else 0), worker)
+                    worker.writing = blocked
+                self.__expire_commands(worker)
+        selector.close()
+        if self.__stats:
+            # the traffic received so far is reported, none is lost when the module stops
+            self.update_stat(self.__stats.flush())
+
+    def __take_commands(self):
+        with self.__lock:
+            self.__signaled = False
+            commands = list(self.__commands)
+            self.__commands.clear()
+        for worker, command, future in commands:
+            worker.outgoing.append((command, future))
+
+    def __send_commands(self, worker: _Worker):
+        # returns True if a command is left because the socket buffer is full
+        while worker.outgoing and len(worker.pending) < self.__window:
+            command, future = worker.outgoing[0]
+            try:
+                worker.control_socket.send(command)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                logging.warning("failed to send command to shadowsocks manager (%s)" % str(e))
+                worker.outgoing.popleft()
+                future.set_result(False)
+                continue
+            worker.outgoing.popleft()
+            worker.pending.append((command, future, time.monotonic()))
+        return False
+
+    def __receive(self, worker: _Worker):
+        for _ in range(_RECEIVE_BATCH):
+            try:
+                data = worker.control_socket.recv(65536)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logging.warning("failed to receive from shadowsocks manager (%s)" % str(e))
+                return
+            if data == b'ok':
+                # the manager answers the commands in the order they are received, and "ok" tells nothing else
+                if worker.pending:
+                    command, future, sent_at = worker.pending.popleft()
+                    self.__ack_metric.observe(time.monotonic() - sent_at)
+                    future.set_result(True)
+            elif data.startswith(b'stat: '):
+                self.__stat_metric.inc()
                 try:
-                    cfg = self.__manage_send_queue.get_nowait()
-                except queue.Empty:
+                    traffic = json.loads(data[6:])
+                except ValueError:
+                    logging.warning("invalid statistic from shadowsocks manager %d" % worker.index)
                     continue
-                self.__control_socket.send(cfg)
-            else:       # timeout, just check if there is sth could be sent
-                if self.__manage_send_queue.empty() is not True:
-                    cfg = self.__manage_send_queue.get_nowait()
-                    self.__control_socket.send(cfg)
+                try:
+                    for port, amount in traffic.items():
+                        self.__stats.add(int(port), int(amount))
+                except (AttributeError, ValueError, TypeError, OverflowError, IndexError):
+                    logging.warning("invalid statistic from shadowsocks manager %d" % worker.index)
+
+    def __expire_commands(self, worker: _Worker):
+        # a late "ok" is taken for the next command, which is acknowledged early in that case
+        deadline = time.monotonic() - self.__ack_timeout
+        while worker.pending and worker.pending[0][2] <= deadline:
+            command, future, sent_at = worker.pending.popleft()
+            logging.warning("shadowsocks manager %d did not acknowledge %s" % (worker.index, _describe(command)))
+            self.__ack_timeout_metric.inc()
+            future.set_result(False)
 
     def update(self, info: list):
-        print(info)
+        # (port, old key, new key, futures) of the users added and removed
+        changes = []
         for conf in info:
-            if conf['action'] == 'add':
-                if 'server_port' in conf['conf'] and 'password' in conf['conf']:
-                    try:
-                        method = conf['conf']['method']
-                    except KeyError:
-                        if self.__method_need_check:
-                            logging.error("shadowsocks server cipher method not set")
-                            continue
-                        else:
-                            method = self.__config['method']
-                    payload = {
-                        'method': method,
-                        'server_port': conf['conf']['server_port'],
-                        'password': conf['conf']['password']
-                    }
-                    self.__manage_send_queue.put(("add:%s" % json.dumps(payload)).encode('ascii'))
-                    self.__user_port[str(conf['conf']['server_port'])] = 0
-                else:
-                    logging.error("invalid configuration syntax, miss port or password")
-            elif conf['action'] == 'remove':
+            action = conf.get('action') if type(conf) is dict else None
+            if action == 'add':
+                user = self.__user_of(conf.get('conf'))
+                if user is not None:
+                    changes.append(self.__add(*user))
+            elif action == 'remove':
+                try:
+                    port = int(conf['conf']['server_port'])
+                except (KeyError, TypeError, ValueError):
+                    logging.error("invalid configuration syntax, miss port")
+                    continue
                 # check if port exist first
-                if conf['action'] in self.__user_port:
-                    self.__manage_send_queue.put('remove:{"server_port":%d}' % int(conf['conf']['server_port']))
+                if port in self.__users:
+                    changes.append(self.__remove(port))
+            elif action == 'sync':
+                self.__sync(conf.get('conf'))
+            else:
+                logging.warning("unknown shadowsocks action: %s" % str(conf))
+        self.__settle([change for change in changes if change is not None])
+
+    def __user_of(self, conf):
+        # returns (port, (method, password)), or None
+        if type(conf) is not dict or 'server_port' not in conf or 'password' not in conf:
+            logging.error("invalid configuration syntax, miss port or password")
+            return None
+        try:
+            method = conf['method']
+        except KeyError:
+            if self.__method_need_check:
+                logging.error("shadowsocks server cipher method not set")
+                return None
+            method = self.__config['method']
+        try:
+            return int(conf['server_port']), (method, conf['password'])
+        except (TypeError, ValueError):
+            logging.error("invalid port '%s'" % conf['server_port'])
+            return None
+
+    def __add(self, port, key):
+        # returns (port, old key, key, futures of the commands sent), or None if the user is running already
+        old = self.__users.get(port)
+        if old == key:
+            return None
+        futures = []
+        if old is not None:
+            # the manager ignores an add for a port which is running, the password is changed by adding it again
+            futures.extend(self.__remove(port)[3])
+        payload = {
+            'method': key[0],
+            'server_port': port,
+            'password': key[1]
+        }
+        futures.append(self.__send(self.__worker_of(port), ("add:%s" % json.dumps(payload)).encode('ascii')))
+        metrics.counter('fusion_shadowsocks_commands_total', "commands sent to the manager", command='add').inc()
+        self.__users[port] = key
+        return port, old, key, futures
+
+    def __remove(self, port):
+        # returns (port, old key, None, futures of the commands sent)
+        old = self.__users.pop(port)
+        metrics.counter('fusion_shadowsocks_commands_total', "commands sent to the manager", command='remove').inc()
+        future = self.__send(self.__worker_of(port), ('remove:{"server_port":%d}' % port).encode('ascii'))
+        return port, old, None, [future]
+
+    def __settle(self, changes: list):
+        # waits for the acknowledgements, and returns the number of commands which failed.
+        # the users are recorded before they are sent, a change which failed is taken back so the next sync retries it
+        sent = [future for change in changes for future in change[3]]
+        if not sent:
+            return 0
+        # the commands are paced by the acknowledgements of the manager, every window of them is done within
+        # ack_timeout. a command still not done after that is taken as failed, and the next sync sends it again
+        timeout = self.__ack_timeout * (len(sent) // self.__window + 2)
+        if not self.__ready.is_set():
+            timeout += self.__ready_timeout
+        concurrent.futures.wait(sent, timeout)
+        for port, old, key, futures in changes:
+            results = [future.done() and future.result() for future in futures]
+            if all(results):
+                continue
+            if old is not None and not results[0]:
+                # the old user may still be running, it is removed again by the next sync
+                self.__users[port] = old
+            else:
+                self.__users.pop(port, None)
+        return sum(1 for future in sent if not (future.done() and future.result()))
+
+    def __worker_of(self, port: int):
+        return self.__workers[self.__ring.get(port)]
+
+    def __sync(self, users):
+        # the controller sends every user, only the difference to the running users is sent to the manager
+        if type(users) is not list:
+            logging.error("invalid shadowsocks sync, a list of users is expected")
+            return
+        start = time.monotonic()
+        desired = {}
+        for conf in users:
+            user = self.__user_of(conf)
+            if user is not None:
+                desired[user[0]] = user[1]
+        changes = [self.__remove(port) for port in [port for port in self.__users if port not in desired]]
+        removed = len(changes)
+        added = rekeyed = 0
+        for port, key in desired.items():
+            if port not in self.__users:
+                added += 1
+            elif self.__users[port] != key:
+                rekeyed += 1
+            change = self.__add(port, key)
+            if change is not None:
+                changes.append(change)
+        failed = self.__settle(changes)
+        elapsed = time.monotonic() - start
+        logging.info("shadowsocks sync: %d added, %d removed, %d re-keyed, %d failed in %.3fs" %
+                     (added, removed, rekeyed, failed, elapsed))
+        self.report({
+            'action': 'sync',
+            'data': {
+                'added': added,
+                'removed': removed,
+                'rekeyed': rekeyed,
+                'unchanged': len(desired) - added - rekeyed,
+                'failed': failed,
+                'time': round(elapsed, 3)
+            }
+        })
 
-    def update_stat(self, user_stat):
-        user_traffic_info = json.loads(user_stat)
-        user_traffic_list = [{'port': port, 'traffic': traffic} for port, traffic in user_traffic_info.items()]
+    def update_stat(self, user_traffic_info: dict):
+        user_traffic_list = [{'port': str(port), 'traffic': traffic} for port, traffic in user_traffic_info.items()]
         self.report({
             'action': 'stat',
             'data': user_traffic_list
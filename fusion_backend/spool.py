@@ -0,0 +1,184 @@
+import collections
+import logging
+import os
+import struct
+import zlib
+
+
+_logger = logging.getLogger('Spool')
+
+# length and crc32 of the record
+_HEADER = struct.Struct('<II')
+_SEGMENT_SUFFIX = '.log'
+_CURSOR_FILE = 'cursor'
+
+
+class Spool(object):
+    # append-only log split into segment files, records are read back in the order they were appended.
+    # only one thread may use a spool
+    def __init__(self, path, max_size=64 * 1024 * 1024, segment_size=4 * 1024 * 1024, fsync=True):
+        self.__path = path
+        self.__max_size = int(max_size)
+        self.__segment_size = int(segment_size)
+        self.__fsync = fsync
+        os.makedirs(path, exist_ok=True)
+        # segment id -> size in bytes, oldest first
+        self.__segments = collections.OrderedDict()
+        for segment in sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(path)
+                              if name.endswith(_SEGMENT_SUFFIX) and name[:-len(_SEGMENT_SUFFIX)].isdigit()):
+            self.__segments[segment] = os.path.getsize(self.__segment_file(segment))
+        self.__read_segment, self.__read_offset = self.__load_cursor()
+        for segment in list(self.__segments):
+            if segment < self.__read_segment:
+                # already replayed, but not deleted before the process stopped
+                self.__delete(segment)
+        if not self.__segments:
+            self.__segments[self.__read_segment] = 0
+        if self.__read_segment not in self.__segments:
+            self.__read_segment, self.__read_offset = next(iter(self.__segments)), 0
+        self.__recover()
+        self.__reader = None
+        self.__next_offset = None
+        self.__writer = open(self.__segment_file(self.__write_segment), 'ab')
+        if self.pending:
+            _logger.info("%d byte(s) of reports are waiting in spool" % self.size)
+
+    @property
+    def __write_segment(self):
+        return next(reversed(self.__segments))
+
+    @property
+    def pending(self):
+        return self.__read_segment != self.__write_segment or \
+            self.__read_offset < self.__segments[self.__write_segment]
+
+    @property
+    def size(self):
+        return sum(self.__segments.values()) - self.__read_offset
+
+    def append(self, record: bytes):
+        length = _HEADER.size + len(record)
+        if self.__segments[self.__write_segment] and \
+                self.__segments[self.__write_segment] + length > self.__segment_size:
+            self.__rotate()
+        while len(self.__segments) > 1 and sum(self.__segments.values()) + length > self.__max_size:
+            self.__drop_oldest()
+        self.__writer.write(_HEADER.pack(len(record), zlib.crc32(record)) + record)
+        self.__writer.flush()
+        if self.__fsync:
+            os.fsync(self.__writer.fileno())
+        self.__segments[self.__write_segment] += length
+
+    def peek(self):
+        # the oldest record not committed yet, or None
+        while self.pending:
+            reader = self.__open_reader()
+            reader.seek(self.__read_offset)
+            header = reader.read(_HEADER.size)
+            if len(header) == _HEADER.size:
+                length, checksum = _HEADER.unpack(header)
+                record = reader.read(length)
+                if len(record) == length and zlib.crc32(record) == checksum:
+                    self.__next_offset = self.__read_offset + _HEADER.size + length
+                    return record
+            if self.__read_segment == self.__write_segment:
+                return None
+            _logger.error("corrupted record in spool segment %d at %d, the rest of the segment is skipped" %
+                          (self.__read_segment, self.__read_offset))
+            self.__next_segment()
+        return None
+
+    def commit(self):
+        # remove the record returned by peek
+        self.__read_offset = self.__next_offset
+        self.__next_offset = None
+        if self.__read_offset >= self.__segments[self.__read_segment]:
+            if self.__read_segment == self.__write_segment:
+                # everything is replayed, start over with an empty segment
+                self.__rotate()
+            self.__next_segment()
+        self.__save_cursor()
+
+    def close(self):
+        self.__writer.close()
+        if self.__reader is not None:
+            self.__reader.close()
+
+    def __segment_file(self, segment):
+        return os.path.join(self.__path, '%08d%s' % (segment, _SEGMENT_SUFFIX))
+
+    def __load_cursor(self):
+        try:
+            with open(os.path.join(self.__path, _CURSOR_FILE), 'r') as file_handle:
+                segment, offset = file_handle.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return (next(iter(self.__segments)) if self.__segments else 0), 0
+
+    def __save_cursor(self):
+        # replace the file at once, so a crash never leaves a broken cursor
+        filename = os.path.join(self.__path, _CURSOR_FILE)
+        with open(filename + '.tmp', 'w') as file_handle:
+            file_handle.write('%d %d\n' % (self.__read_segment, self.__read_offset))
+            file_handle.flush()
+            if self.__fsync:
+                os.fsync(file_handle.fileno())
+        os.replace(filename + '.tmp', filename)
+
+    def __recover(self):
+        # cut a record which was partially written when the process stopped
+        segment = self.__write_segment
+        offset = self.__read_offset if segment == self.__read_segment else 0
+        with open(self.__segment_file(segment), 'ab+') as file_handle:
+            file_handle.seek(offset)
+            while True:
+                header = file_handle.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, checksum = _HEADER.unpack(header)
+                record = file_handle.read(length)
+                if len(record) < length or zlib.crc32(record) != checksum:
+                    break
+                offset += _HEADER.size + length
+            if offset < self.__segments[segment]:
+                _logger.warning("spool segment %d is truncated from %d to %d bytes" %
+                                (segment, self.__segments[segment], offset))
+                file_handle.truncate(offset)
+                self.__segments[segment] = offset
+
+    def __rotate(self):
+        self.__writer.close()
+        segment = self.__write_segment + 1
+        self.__segments[segment] = 0
+        self.__writer = open(self.__segment_file(segment), 'ab')
+
+    def __open_reader(self):
+        if self.__reader is None:
+            self.__reader = open(self.__segment_file(self.__read_segment), 'rb')
+        return self.__reader
+
+    def __next_segment(self):
+        segment = self.__read_segment
+        if self.__reader is not None:
+            self.__reader.close()
+            self.__reader = None
+        self.__read_segment, self.__read_offset = list(self.__segments)[1], 0
+        self.__delete(segment)
+
+    def __drop_oldest(self):
+        segment = next(iter(self.__segments))
+        _logger.warning("spool is full, %d byte(s) of reports in segment %d are dropped" %
+                        (self.__segments[segment] - (self.__read_offset if segment == self.__read_segment else 0),
+                         segment))
+        if segment == self.__read_segment:
+            self.__next_segment()
+            self.__save_cursor()
+        else:
+            self.__delete(segment)
+
+    def __delete(self, segment):
+        del self.__segments[segment]
+        try:
+            os.remove(self.__segment_file(segment))
+        except FileNotFoundError:
+            pass
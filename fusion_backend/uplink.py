@@ -0,0 +1,200 @@
+import collections
+import json
+import logging
+import random
+import selectors
+import socket
+import threading
+import time
+import urllib.parse
+
+
+_logger = logging.getLogger('Uplink')
+
+# at most this number of frames are passed to one sendmsg call
+_SEND_BATCH = 64
+
+
+def _encode(payload):
+    # one json document per line, compact json never contains a newline
+    return json.dumps(payload, separators=(',', ':')).encode() + b'\n'
+
+
+class TCPUplink(threading.Thread):
+    # persistent connection to the controller, frames are pipelined without waiting for a response
+    def __init__(self, conf: dict):
+        super(TCPUplink, self).__init__()
+        self.setDaemon(True)
+        controller = conf['controller']
+        if '://' in controller:
+            controller = urllib.parse.urlsplit(controller).hostname
+        self.__address = (controller, int(conf['controller_port']))
+        timeout = conf.get('controller_timeout', [5, 30])
+        self.__connect_timeout = float(timeout[0] if type(timeout) is list else timeout)
+        self.__heartbeat_interval = float(conf.get('heartbeat_interval', 30))
+        self.__max_backoff = float(conf.get('reconnect_max_interval', 60))
+        self.__buffer_limit = int(conf.get('controller_buffer', 4 * 1024 * 1024))
+        self.__hello = _encode({'version': 1, 'node': conf['node'], 'key': conf['controller_key']})
+        self.__heartbeat = _encode({'version': 1, 'node': conf['node'], 'data': []})
+        # frames waiting to be sent, shared with the reporter thread
+        self.__frames = collections.deque()
+        self.__buffered = 0
+        self.__dropped = 0
+        self.__lock = threading.Lock()
+        self.__drained = threading.Condition(self.__lock)
+        self.__signaled = False
+        self.__reader, self.__writer = socket.socketpair()
+        self.__reader.setblocking(False)
+        self.__writer.setblocking(False)
+        # frames taken by the uplink thread, the first one may be partially sent
+        self.__sending = collections.deque()
+        self.__offset = 0
+        # size of the reports in __sending
+        self.__in_flight = 0
+        self.__stopped = threading.Event()
+        self.connected = False
+
+    def send(self, payload, timeout=None):
+        frame = _encode(payload)
+        with self.__lock:
+            # while connected, wait for the link to catch up instead of dropping reports
+            self.__drained.wait_for(lambda: not self.connected or
+                                    self.__buffered + self.__in_flight < self.__buffer_limit, timeout)
+            self.__frames.append(frame)
+            self.__buffered += len(frame)
+            # keep the newest reports when the controller is unreachable for too long
+            while self.__buffered > self.__buffer_limit and len(self.__frames) > 1:
+                self.__buffered -= len(self.__frames.popleft())
+                self.__dropped += 1
+            if self.__signaled:
+                return
+            self.__signaled = True
+        try:
+            self.__writer.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def stop(self):
+        # returns the reports not sent yet, so they can be sent in another way
+        self.__stopped.set()
+        try:
+            self.__writer.send(b'\0')
+        except BlockingIOError:
+            pass
+        if self.is_alive():
+            self.join()
+        self.__reader.close()
+        self.__writer.close()
+        with self.__lock:
+            frames = list(self.__frames)
+            self.__frames.clear()
+            self.__buffered = 0
+        return [json.loads(frame.decode()) for frame in frames]
+
+    def run(self):
+        backoff = 1
+        while not self.__stopped.is_set():
+            try:
+                sock = socket.create_connection(self.__address, timeout=self.__connect_timeout)
+            except OSError as e:
+                # add some jitter, so nodes do not reconnect at the same time after a controller restart
+                delay = backoff * random.uniform(0.5, 1)
+                _logger.warning("failed to connect to controller [%s]:%d (%s), retry in %.1fs" %
+                                (self.__address + (str(e), delay)))
+                self.__stopped.wait(delay)
+                backoff = min(backoff * 2, self.__max_backoff)
+                continue
+            _logger.info("connected to controller [%s]:%d" % self.__address)
+            backoff = 1
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connected = True
+            try:
+                self.__serve(sock)
+            except OSError as e:
+                _logger.warning("connection to controller lost (%s)" % str(e))
+            finally:
+                with self.__lock:
+                    self.connected = False
+                    self.__drained.notify_all()
+                sock.close()
+            self.__requeue()
+
+    def __serve(self, sock: socket.socket):
+        selector = selectors.DefaultSelector()
+        selector.register(self.__reader, selectors.EVENT_READ)
+        selector.register(sock, selectors.EVENT_READ)
+        # a partially sent frame is sent again from the beginning on a new connection
+        self.__sending.appendleft(self.__hello)
+        self.__offset = 0
+        last_send = time.monotonic()
+        try:
+            while not self.__stopped.is_set():
+                self.__take()
+                selector.modify(sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if self.__sending else 0))
+                timeout = last_send + self.__heartbeat_interval - time.monotonic()
+                if timeout <= 0 and not self.__sending:
+                    self.__sending.append(self.__heartbeat)
+                    continue
+                for key, mask in selector.select(max(timeout, 0)):
+                    if key.fileobj is self.__reader:
+                        try:
+                            self.__reader.recv(4096)
+                        except BlockingIOError:
+                            pass
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        # the controller does not send anything on this channel, but the read tells a closed connection
+                        try:
+                            if sock.recv(4096) == b'':
+                                raise ConnectionResetError("closed by controller")
+                        except BlockingIOError:
+                            pass
+                    if mask & selectors.EVENT_WRITE:
+                        self.__write(sock)
+                        last_send = time.monotonic()
+        finally:
+            selector.close()
+
+    def __take(self):
+        with self.__lock:
+            self.__signaled = False
+            if self.__frames:
+                self.__sending.extend(self.__frames)
+                self.__frames.clear()
+                self.__in_flight += self.__buffered
+                self.__buffered = 0
+            dropped, self.__dropped = self.__dropped, 0
+        if dropped:
+            _logger.warning("uplink buffer is full, %d report(s) dropped" % dropped)
+
+    def __write(self, sock: socket.socket):
+        buffers = [memoryview(self.__sending[0])[self.__offset:]]
+        for index in range(1, min(len(self.__sending), _SEND_BATCH)):
+            buffers.append(self.__sending[index])
+        try:
+            sent = sock.sendmsg(buffers)
+        except BlockingIOError:
+            return
+        sent += self.__offset
+        completed = 0
+        while self.__sending and sent >= len(self.__sending[0]):
+            frame = self.__sending.popleft()
+            sent -= len(frame)
+            if frame is not self.__hello and frame is not self.__heartbeat:
+                completed += len(frame)
+        self.__offset = sent
+        if completed:
+            with self.__lock:
+                self.__in_flight -= completed
+                self.__drained.notify_all()
+
+    def __requeue(self):
+        # frames not completely sent go back to the front of the queue, hello and heartbeats are not needed any more
+        frames = [frame for frame in self.__sending if frame is not self.__hello and frame is not self.__heartbeat]
+        self.__sending.clear()
+        self.__offset = 0
+        with self.__lock:
+            self.__frames.extendleft(reversed(frames))
+            self.__buffered += self.__in_flight
+            self.__in_flight = 0
@@ -0,0 +1,161 @@
+import logging
+import asyncio
+import concurrent.futures
+
+import tornado.web
+import tornado.httpserver
+import tornado.ioloop
+import tornado.gen
+import tornado.concurrent
+import tornado.netutil
+from queue import Queue
+
+from client import Client
+from fusion_backend import metrics
+
+
+# envelopes smaller than this are decoded in the io loop, the thread pool costs more than that
+_INLINE_PARSE_SIZE = 64 * 1024
+
+
+class HTTPClient(Client):
+    def __init__(self, queue: Queue, conf: dict):
+        super(HTTPClient, self).__init__(queue)
+        self.__conf = conf
+        # big pushes are decoded out of the io loop, so other requests are not held up
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(conf.get('client_workers', 2)))
+        handlers = [
+            (r'/', HTTPHandler, dict(conf=conf, client=self, executor=self.__executor))
+        ]
+        metrics_conf = conf.get('metrics', {})
+        if metrics_conf is not False:
+            handlers.append((metrics_conf.get('path', '/metrics'), MetricsHandler,
+                             dict(allow=metrics_conf.get('allow', ['127.0.0.1', '::1']))))
+        self.__application = tornado.web.Application(handlers)
+        self.__http_server = tornado.httpserver.HTTPServer(self.__application)
+        self.__loop = asyncio.new_event_loop()
+        if type(conf['client']) is str:
+            conf['client'] = [conf['client']]
+        self.__sockets = []
+        try:
+            for client_addr in conf['client']:
+                self.__sockets.extend(tornado.netutil.bind_sockets(self.__conf['client_port'], client_addr))
+        except OSError:
+            # release the addresses already bound
+            for sock in self.__sockets:
+                sock.close()
+            raise
+
+    def run(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__http_server.add_sockets(self.__sockets)
+        tornado.ioloop.IOLoop.current().start()
+        tornado.ioloop.IOLoop.current().close(all_fds=True)
+        self.__executor.shutdown(wait=False)
+
+    def stop(self):
+        self.__loop.call_soon_threadsafe(self.__shutdown)
+        if self.is_alive():
+            self.join()
+
+    def __shutdown(self):
+        self.__http_server.stop()
+        tornado.ioloop.IOLoop.current().stop()
+
+
+# noinspection PyAbstractClass
+@tornado.web.stream_request_body
+class HTTPHandler(tornado.web.RequestHandler):
+    # conf = None
+
+    def __init__(self, application, request, **kwargs):
+        super(HTTPHandler, self).__init__(application, request, **kwargs)
+        self.conf = kwargs['conf']
+        self.client = kwargs['client']
+        self.executor = kwargs['executor']
+        self.ndjson = False
+        self.buffer = bytearray()
+        self.scanned = 0
+        # parse results of the envelopes in the order they are received
+        self.parsed = []
+
+    # noinspection PyMethodOverriding
+    @tornado.gen.coroutine
+    def initialize(self, **kwargs):
+        pass
+
+    def prepare(self):
+        if self.request.method != 'POST':
+            return
+        if self.request.headers.get('key') != self.conf['controller_key']:
+            logging.warning("controller key mismatch from '%s'" % self.request.remote_ip)
+            raise tornado.web.HTTPError(403)
+        content_type = self.request.headers.get('Content-Type', '').split(';')[0].strip()
+        if content_type in ('application/x-ndjson', 'application/ndjson'):
+            # one Fusion-API envelope per line
+            self.ndjson = True
+        elif content_type != 'application/json':
+            raise tornado.web.HTTPError(415)
+        self.request.connection.set_max_body_size(int(self.conf.get('client_max_message_size', 64 * 1024 * 1024)))
+
+    def data_received(self, chunk):
+        self.buffer += chunk
+        if not self.ndjson:
+            return
+        # envelopes are decoded while the rest of the body is still being received
+        start = 0
+        end = self.buffer.find(b'\n', self.scanned)
+        while end >= 0:
+            self.__parse(bytes(self.buffer[start:end]))
+            start = end + 1
+            end = self.buffer.find(b'\n', start)
+        if start:
+            del self.buffer[:start]
+        self.scanned = len(self.buffer)
+
+    def __parse(self, raw_json):
+        if not raw_json.strip():
+            return
+        if len(raw_json) < _INLINE_PARSE_SIZE:
+            future = tornado.concurrent.Future()
+            future.set_result(Client.parse(raw_json))
+            self.parsed.append(future)
+        else:
+            # wrapped by the io loop, so it is woken up when the worker is done
+            self.parsed.append(tornado.ioloop.IOLoop.current().run_in_executor(self.executor, Client.parse, raw_json))
+
+    @tornado.gen.coroutine
+    def get(self, *args, **kwargs):
+        self.write("<h1>Error 418 - I'm a Teapot</h1><p>You attempt to brew coffee with a teapot.</p>")
+        self.set_status(418, "I'm a teapot")
+
+    @tornado.gen.coroutine
+    def post(self, *args, **kwargs):
+        self.__parse(bytes(self.buffer))
+        self.buffer = bytearray()
+        result = []
+        for data, error in (yield self.parsed):
+            if error is not None:
+                result.append({'error': error})
+            else:
+                # queued in the order of the envelopes
+                result.append(self.client.enqueue(data))
+        self.write({
+            'version': 1,
+            'result': result
+        })
+
+
+# noinspection PyAbstractClass
+class MetricsHandler(tornado.web.RequestHandler):
+    # prometheus scrape endpoint, only for the local addresses in allow
+
+    # noinspection PyMethodOverriding
+    def initialize(self, allow):
+        self.allow = allow
+
+    def get(self, *args, **kwargs):
+        if self.request.remote_ip not in self.allow:
+            raise tornado.web.HTTPError(403)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
@@ -0,0 +1,112 @@
+import queue
+import socket
+import threading
+import time
+import unittest
+
+from fusion_backend.modules import relay
+
+
+class _EchoServer(object):
+    # answers every datagram with its tag and the datagram
+    def __init__(self, tag: bytes):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.__tag = tag
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+                self.sock.sendto(self.__tag + b':' + data, addr)
+            except OSError:
+                return
+
+    def close(self):
+        self.sock.close()
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class UDPRuleChangeTest(unittest.TestCase):
+    def setUp(self):
+        self.first = _EchoServer(b'first')
+        self.second = _EchoServer(b'second')
+        self.port = _free_port()
+        self.relay = relay.get_module(queue.Queue(), {
+            'port_begin': self.port,
+            'port_end': self.port,
+            'multiprocessing': False,
+            'relay_addr': ['127.0.0.1'],
+            'rules': {'udp': {str(self.port): '127.0.0.1:%d' % self.first.port}},
+            'report_interval': 60,
+            'drain_timeout': 1
+        })
+        self.relay.start()
+        self.clients = []
+
+    def tearDown(self):
+        self.relay.stop()
+        for sock in self.clients + [self.first, self.second]:
+            sock.close()
+
+    def client(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(0.1)
+        self.clients.append(sock)
+        return sock
+
+    def ask(self, sock):
+        # rule changes are applied by the relay thread, so the first datagrams may be sent before
+        for _ in range(20):
+            sock.sendto(b'ping', ('127.0.0.1', self.port))
+            try:
+                return sock.recv(65535)
+            except socket.timeout:
+                continue
+        return None
+
+    def update(self, action, destination=None, **options):
+        conf = dict(options, type='udp', port=self.port)
+        if destination is not None:
+            conf['destination'] = '127.0.0.1:%d' % destination.port
+        self.relay.update([{'action': action, 'conf': conf}])
+
+    def test_change_destination(self):
+        old = self.client()
+        self.assertEqual(self.ask(old), b'first:ping')
+        self.update('add', self.second)
+        self.assertEqual(self.ask(self.client()), b'second:ping')
+        # the existing session keeps its destination until the old rule is drained
+        self.assertEqual(self.ask(old), b'first:ping')
+        time.sleep(2.5)
+        self.assertEqual(self.ask(self.client()), b'second:ping')
+        self.assertEqual(self.ask(old), b'second:ping')
+
+    def test_remove_and_add(self):
+        self.assertEqual(self.ask(self.client()), b'first:ping')
+        self.update('remove')
+        self.update('add', self.first)
+        self.assertEqual(self.ask(self.client()), b'first:ping')
+        time.sleep(2.5)
+        self.assertEqual(self.ask(self.client()), b'first:ping')
+
+    def test_invalid_options(self):
+        self.update('add', self.second, timeout='fast')
+        self.assertEqual(self.ask(self.client()), b'first:ping')
+        self.update('add', self.second, timeout=5)
+        self.assertEqual(self.ask(self.client()), b'second:ping')
+
+
+if __name__ == '__main__':
+    unittest.main()